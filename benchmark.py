@@ -0,0 +1,345 @@
+import argparse
+import io
+import json
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from capture import BurstWriter
+from merge import HdrAccumulator
+from processing import SHARPEN_SIGMA, AdjustmentEngine, StripProcessor, TileProcessor, yuv420_to_rgb
+from storage import StorageWriter
+
+SIZES = [(640, 480), (1280, 720), (2028, 1080)]
+
+# Stills, bursts and HDR run at the sensor's full resolution (HQ camera)
+CAPTURE_SIZES = [(4056, 3040)]
+
+# Width of the lores stream the preview is sharpened at; stills scale the
+# blur from it, as CameraApp.still_sigma() does
+PREVIEW_WIDTH = 640
+
+# The app's defaults: PITA_STILL_BUDGET_MB, the StillWriter budget and
+# JPEG quality
+STILL_BUDGET = 32 * 1024 * 1024
+STILL_WRITER_BUDGET = 128 * 1024 * 1024
+JPEG_QUALITY = 90
+
+# Exposure times of the HDR bracket, in seconds
+HDR_EXPOSURES = (1 / 240, 1 / 60, 1 / 15)
+
+# Slider combinations as (brightness, contrast, saturation, sharpness)
+COMBINATIONS = {
+    "neutral": (0.0, 1.0, 1.0, 1.0),
+    "saturation": (0.0, 1.0, 1.5, 1.0),
+    "sharpening": (0.0, 1.0, 1.0, 1.5),
+    "all": (0.2, 1.2, 1.4, 1.5),
+}
+
+# Relative change in fps or p99 latency that counts as a regression
+DEFAULT_TOLERANCE = 0.10
+
+
+def synthetic_yuv(width, height, seed=0):
+    """An I420 frame with gradients and noise, roughly like a real scene"""
+    rng = np.random.default_rng(seed)
+    y = np.add.outer(np.arange(height), np.arange(width)) * (255.0 / (width + height))
+    y = y + rng.normal(0, 12, (height, width))
+    chroma = rng.integers(96, 160, (height // 2, width), dtype=np.uint8)
+    return np.concatenate((np.clip(y, 0, 255).astype(np.uint8), chroma))
+
+
+def recorded_yuv(path, width, height, limit):
+    """Read up to `limit` raw I420 frames of the given size from a file"""
+    frame_bytes = width * height * 3 // 2
+    data = np.fromfile(path, dtype=np.uint8)
+    count = min(len(data) // frame_bytes, limit)
+    if not count:
+        raise ValueError(f"{path} holds no complete {width}x{height} I420 frame")
+    return [
+        data[i * frame_bytes:(i + 1) * frame_bytes].reshape(height * 3 // 2, width)
+        for i in range(count)
+    ]
+
+
+def load_frames(args, width, height):
+    if args.input:
+        return recorded_yuv(args.input, width, height, args.frames)
+    return [synthetic_yuv(width, height, seed) for seed in range(4)]
+
+
+def preview_pipeline(engine, width, height, sharpen=True):
+    """The serial preview path CameraApp runs for every frame"""
+    out = np.empty((height, width, 3), dtype=np.uint8)
+
+    def process(yuv):
+        yuv420_to_rgb(yuv, out)
+        engine.apply(out, out=out, sharpen=sharpen)
+
+    return process
+
+
+def run_case(frames, process, count):
+    """Time `count` frames and measure peak allocations; returns a result dict"""
+    process(frames[0])  # Warm up
+
+    latencies = np.empty(count, dtype=np.float64)
+    start = time.perf_counter()
+    for i in range(count):
+        frame_start = time.perf_counter()
+        process(frames[i % len(frames)])
+        latencies[i] = time.perf_counter() - frame_start
+    elapsed = time.perf_counter() - start
+
+    # Separate pass, tracemalloc slows allocation down
+    tracemalloc.start()
+    for i in range(min(count, 10)):
+        process(frames[i % len(frames)])
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "fps": count / elapsed,
+        "p50_ms": float(np.percentile(latencies, 50)) * 1000.0,
+        "p99_ms": float(np.percentile(latencies, 99)) * 1000.0,
+        "peak_alloc_mb": peak / 1e6,
+    }
+
+
+def run_suite(args):
+    results = {}
+    for width, height in args.sizes:
+        frames = load_frames(args, width, height)
+        for name, params in COMBINATIONS.items():
+            engine = AdjustmentEngine()
+            engine.set_params(*params)
+            result = run_case(frames, preview_pipeline(engine, width, height), args.frames)
+            key = f"{width}x{height}/{name}"
+            results[key] = result
+            print(
+                f"{key:<24} {result['fps']:7.1f} fps  p50 {result['p50_ms']:6.2f} ms  "
+                f"p99 {result['p99_ms']:6.2f} ms  peak {result['peak_alloc_mb']:6.1f} MB"
+            )
+
+    return {
+        "machine": platform.machine(),
+        "cpus": cv2.getNumberOfCPUs(),
+        "python": platform.python_version(),
+        "opencv": cv2.__version__,
+        "numpy": np.__version__,
+        "frames": args.frames,
+        "input": args.input or "synthetic",
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+        "results": results,
+    }
+
+
+def compare(report, baseline, tolerance):
+    """Print regressions against a saved baseline; returns True if any"""
+    regressed = False
+    for key, result in report["results"].items():
+        base = baseline.get("results", {}).get(key)
+        if not base:
+            continue
+        fps_change = result["fps"] / base["fps"] - 1.0
+        p99_change = result["p99_ms"] / base["p99_ms"] - 1.0
+        if fps_change < -tolerance or p99_change > tolerance:
+            regressed = True
+            print(
+                f"REGRESSION {key}: fps {base['fps']:.1f} -> {result['fps']:.1f} "
+                f"({fps_change:+.0%}), p99 {base['p99_ms']:.2f} -> {result['p99_ms']:.2f} ms "
+                f"({p99_change:+.0%})"
+            )
+    if not regressed:
+        print(f"No regressions beyond {tolerance:.0%} against the baseline")
+    return regressed
+
+
+def bench_strips(width, height, max_workers, count):
+    """Compare the serial preview pipeline with 1..max_workers strip workers
+
+    Both with sharpening, where strips need halo rows, and without, as at
+    sharpness 1.0 or the governor's reduced tiers.
+    """
+    engine = AdjustmentEngine()
+    engine.set_params(*COMBINATIONS["all"])
+    frames = [synthetic_yuv(width, height, seed) for seed in range(4)]
+    out = np.empty((height, width, 3), dtype=np.uint8)
+
+    for sharpen in (True, False):
+        pipeline = preview_pipeline(engine, width, height, sharpen)
+        baseline = run_case(frames, pipeline, count)["fps"]
+        label = "sharpened" if sharpen else "not sharpened"
+        print(f"{width}x{height}, {label}, {cv2.getNumberOfCPUs()} CPUs")
+        print(f"  serial     {1000.0 / baseline:7.2f} ms/frame  {baseline:6.1f} fps")
+
+        for workers in range(1, max_workers + 1):
+            strips = StripProcessor(engine, workers)
+            fps = run_case(frames, lambda yuv: strips.process(yuv, out, sharpen), count)["fps"]
+            strips.shutdown()
+            print(
+                f"  {workers} worker{'s' if workers > 1 else ' '}  {1000.0 / fps:7.2f} ms/frame  "
+                f"{fps:6.1f} fps  x{fps / baseline:.2f}"
+            )
+
+
+def bench_captures(width, height, count):
+    """Time the full resolution capture paths, `count` frames each
+
+    Stills: the TileProcessor pass at the default budget for each slider
+    combination, then the JPEG encode the still writer does. Bursts:
+    frames through BurstWriter's process pool, written without fsync to a
+    temporary directory. HDR: three-frame brackets through HdrAccumulator
+    and its tone map.
+    """
+    frames = [yuv420_to_rgb(synthetic_yuv(width, height, seed)) for seed in range(min(count, 4))]
+    sigma = SHARPEN_SIGMA * width / PREVIEW_WIDTH
+    print(f"{width}x{height}, {cv2.getNumberOfCPUs()} CPUs")
+
+    tiles = TileProcessor(budget=STILL_BUDGET)
+    for name, params in COMBINATIONS.items():
+        engine = AdjustmentEngine()
+        engine.set_params(*params)
+        latencies = []
+        for i in range(count):
+            image = frames[i % len(frames)].copy()
+            started = time.perf_counter()
+            tiles.process(image, engine, sigma)
+            latencies.append(time.perf_counter() - started)
+        print(
+            f"  still {name:<11} {np.median(latencies) * 1000.0:7.1f} ms  "
+            f"{tiles.last_tiles} tiles, {tiles.last_in_flight} at a time, "
+            f"{tiles.last_peak_bytes / 1e6:.1f} MB scratch"
+        )
+    tiles.shutdown()
+
+    latencies = []
+    for i in range(count):
+        buffer = io.BytesIO()
+        started = time.perf_counter()
+        Image.fromarray(frames[i % len(frames)]).save(buffer, format="JPEG", quality=JPEG_QUALITY)
+        latencies.append(time.perf_counter() - started)
+    print(
+        f"  still JPEG        {np.median(latencies) * 1000.0:7.1f} ms  "
+        f"{len(buffer.getvalue()) / 1e6:.1f} MB"
+    )
+
+    # The app sizes the burst buffer from the still writer's budget
+    shape = (height, width, 3)
+    slots = max(2, STILL_WRITER_BUDGET // frames[0].nbytes)
+    workers = os.cpu_count() or 1
+    params = COMBINATIONS["all"]
+    storage = StorageWriter(fsync="never")
+    writer = BurstWriter(storage, shape, slots, workers=workers, quality=JPEG_QUALITY)
+    with tempfile.TemporaryDirectory() as directory:
+
+        def burst(frame_count):
+            futures = []
+            for i in range(frame_count):
+                slot = writer.acquire_slot()
+                writer.slot_array(slot)[:] = frames[i % len(frames)]
+                path = os.path.join(directory, f"burst_{i:04d}.jpg")
+                futures.append(writer.submit(slot, path, params, sigma))
+            for future in futures:
+                future.result()
+
+        burst(1)  # Warm up, the worker processes start on first use
+        started = time.perf_counter()
+        burst(count)
+        elapsed = time.perf_counter() - started
+    writer.shutdown()
+    print(
+        f"  burst             {elapsed / count * 1000.0:7.1f} ms/frame  {count / elapsed:.2f} fps  "
+        f"{workers} processes, {slots} slots"
+    )
+
+    brackets = [
+        np.clip(frames[0] * (exposure / HDR_EXPOSURES[1]), 0, 255).astype(np.uint8)
+        for exposure in HDR_EXPOSURES
+    ]
+    merge_times = []
+    tonemap_times = []
+    for _ in range(count):
+        started = time.perf_counter()
+        accumulator = HdrAccumulator(shape)
+        for image, exposure in zip(brackets, HDR_EXPOSURES):
+            accumulator.add(image, exposure)
+        merged = time.perf_counter()
+        accumulator.tonemap()
+        merge_times.append(merged - started)
+        tonemap_times.append(time.perf_counter() - merged)
+        del accumulator
+    print(
+        f"  HDR merge         {np.median(merge_times) * 1000.0:7.1f} ms  "
+        f"{len(HDR_EXPOSURES)} frames, tone map {np.median(tonemap_times) * 1000.0:.1f} ms"
+    )
+
+
+def parse_size(text):
+    width, height = (int(v) for v in text.split("x"))
+    return width, height
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Headless benchmarks for the preview and capture pipelines"
+    )
+    parser.add_argument(
+        "--size", dest="sizes", type=parse_size, action="append",
+        help=(
+            "Frame size, WxH (repeatable; default 640x480, 1280x720 and 2028x1080, "
+            "or 4056x3040 with --captures)"
+        ),
+    )
+    parser.add_argument("--frames", type=int, default=200, help="Frames per case")
+    parser.add_argument("--input", help="Raw I420 file to replay instead of synthetic frames")
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    parser.add_argument("--baseline", help="JSON results to compare against")
+    parser.add_argument(
+        "--tolerance", type=float, default=DEFAULT_TOLERANCE,
+        help="Allowed relative fps drop or p99 increase before failing",
+    )
+    parser.add_argument(
+        "--strips", type=int, metavar="N",
+        help="Instead of the suite, compare strip-parallel processing with 1..N workers",
+    )
+    parser.add_argument(
+        "--captures", type=int, metavar="N",
+        help="Instead of the suite, time still, burst and HDR processing on N frames each",
+    )
+    args = parser.parse_args()
+
+    if args.captures:
+        for width, height in args.sizes or CAPTURE_SIZES:
+            bench_captures(width, height, args.captures)
+        return 0
+
+    args.sizes = args.sizes or SIZES
+    if args.strips:
+        for width, height in args.sizes:
+            bench_strips(width, height, args.strips, args.frames)
+        return 0
+
+    report = run_suite(args)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(report, baseline, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,280 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import cv2
+import numpy as np
+
+from processing import yuv420_to_rgb
+
+# Full resolution of the HQ camera, which the fake camera pretends to be
+FAKE_SENSOR_RESOLUTION = (4056, 3040)
+
+
+def create_camera(spec=None):
+    """Create the camera backend named by `spec`
+
+    None or "picamera2" opens the real camera. "fake" replays a synthetic
+    test pattern and "fake:<path>" replays raw I420 frames from a file; both
+    implement the subset of the Picamera2 API that CameraApp uses.
+    """
+    if not spec or spec == "picamera2":
+        from picamera2 import Picamera2
+
+        return Picamera2()
+    if spec == "fake":
+        return ReplayCamera()
+    if spec.startswith("fake:"):
+        return ReplayCamera(spec[len("fake:"):])
+    raise ValueError(f"Unknown camera backend {spec!r}")
+
+
+@contextmanager
+def mapped_array(request, name):
+    """A numpy view of a request's stream, valid until the block exits
+
+    Unlike make_array this doesn't copy the frame on a real camera, so it is
+    the way to read every frame of a full rate stream.
+    """
+    if isinstance(request, ReplayRequest):
+        yield request.make_array(name)
+        return
+
+    from picamera2 import MappedArray
+
+    with MappedArray(request, name) as mapped:
+        yield mapped.array
+
+
+class ReplayRequest:
+    """Stand-in for a picamera2 CompletedRequest"""
+
+    def __init__(self, camera, config, frame, timestamp):
+        self.camera = camera
+        self.config = config
+        self.frame = frame  # I420 lores frame, possibly a view into a memmap
+        self.timestamp = timestamp
+        self.exposure = camera.exposure_time()
+        self.refcount = 1
+
+    def make_array(self, name):
+        stream = self.config[name]
+        width, height = stream["size"]
+        # A manual exposure brightens or darkens the recorded frames
+        gain = self.exposure / self.camera.auto_exposure()
+        if stream["format"] == "YUV420":
+            if self.frame.shape == (height * 3 // 2, width) and gain == 1.0:
+                return np.array(self.frame)
+            rgb = cv2.resize(yuv420_to_rgb(self.frame), (width, height))
+            rgb = cv2.convertScaleAbs(rgb, alpha=gain)
+            return cv2.cvtColor(rgb, cv2.COLOR_RGB2YUV_I420)
+
+        # Every other stream is derived from the lores frame by upscaling
+        rgb = cv2.resize(yuv420_to_rgb(self.frame), (width, height))
+        if gain != 1.0:
+            rgb = cv2.convertScaleAbs(rgb, alpha=gain)
+        if stream["format"] in ("XBGR8888", "XRGB8888"):
+            return cv2.cvtColor(rgb, cv2.COLOR_RGB2RGBA)
+        return rgb
+
+    def get_metadata(self):
+        return {
+            "SensorTimestamp": self.timestamp,
+            "FrameDuration": int(self.camera.frame_duration * 1e6),
+            "ExposureTime": self.exposure,
+            "AnalogueGain": 1.0,
+        }
+
+    def acquire(self):
+        self.refcount += 1
+
+    def release(self):
+        self.refcount -= 1
+
+
+class ReplayCamera:
+    """A fake camera that replays I420 frames at real sensor timing.
+
+    Frames come from a raw I420 file at the lores size, memory-mapped so
+    only the frames being delivered are paged in, or from a generated test
+    pattern. A pacing thread delivers one frame per frame duration against a
+    monotonic clock, calls post_callback and wakes capture_* waiters, just
+    like the Picamera2 event loop does.
+    """
+
+    def __init__(self, path=None, fps=30.0):
+        self.path = path
+        self.sensor_resolution = FAKE_SENSOR_RESOLUTION
+        self.frame_duration = 1.0 / fps
+        self.controls = {}
+        self.post_callback = None
+
+        self.config = None
+        self.frames = None
+        self.frame_index = 0
+        self.latest = None
+        self.sequence = 0
+        self.condition = threading.Condition()
+        self.running = False
+        self.thread = None
+        self.encoder = None
+        self.output = None
+
+    # Configuration
+
+    def create_video_configuration(self, main=None, lores=None, buffer_count=6, **kwargs):
+        return self.create_configuration("video", main, lores, "XBGR8888", buffer_count, kwargs)
+
+    def create_still_configuration(self, main=None, lores=None, buffer_count=1, **kwargs):
+        return self.create_configuration("still", main, lores, "BGR888", buffer_count, kwargs)
+
+    def create_configuration(self, use_case, main, lores, main_format, buffer_count, kwargs):
+        config = {
+            "use_case": use_case,
+            "main": {"size": (640, 480), "format": main_format},
+            "lores": None,
+            "buffer_count": buffer_count,
+        }
+        config["main"].update(main or {})
+        if lores is not None:
+            config["lores"] = {"size": (320, 240), "format": "YUV420"}
+            config["lores"].update(lores)
+        config.update(kwargs)
+        return config
+
+    def configure(self, config):
+        self.config = config
+        stream = config["lores"] or config["main"]
+        self.frames = self.load_frames(*stream["size"])
+
+    def load_frames(self, width, height):
+        if self.path:
+            frame_bytes = width * height * 3 // 2
+            count = os.path.getsize(self.path) // frame_bytes
+            if not count:
+                raise ValueError(f"{self.path} holds no complete {width}x{height} I420 frame")
+            return np.memmap(
+                self.path, dtype=np.uint8, mode="r", shape=(count, height * 3 // 2, width)
+            )
+
+        # Moving diagonal bars over a gradient, enough to see motion and colour
+        frames = np.empty((30, height * 3 // 2, width), dtype=np.uint8)
+        ramp = np.add.outer(np.arange(height), np.arange(width))
+        for i in range(len(frames)):
+            frames[i, :height] = ((ramp + i * 8) % 128 + (ramp * 255 // (width + height)) // 2).astype(np.uint8)
+            frames[i, height:] = 128 + ((np.arange(width) + i * 4) % 64 - 32)
+        return frames
+
+    # Running
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self.pace_frames, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread and self.thread is not threading.current_thread():
+            self.thread.join()
+        self.thread = None
+
+    def close(self):
+        self.stop()
+        self.frames = None
+
+    def pace_frames(self):
+        """Deliver one frame per frame duration, scheduled on a monotonic clock"""
+        deadline = time.monotonic()
+        while self.running:
+            deadline += self.frame_duration
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                deadline = time.monotonic()  # Fell behind, don't burst
+
+            frame = self.frames[self.frame_index % len(self.frames)]
+            self.frame_index += 1
+            request = ReplayRequest(self, self.config, frame, time.monotonic_ns())
+
+            if self.post_callback:
+                try:
+                    self.post_callback(request)
+                except Exception as e:
+                    print(f"Fake camera post_callback error: {e}")
+
+            with self.condition:
+                self.latest = request
+                self.sequence += 1
+                self.condition.notify_all()
+
+    def wait_for_request(self):
+        with self.condition:
+            sequence = self.sequence
+            if not self.condition.wait_for(lambda: self.sequence != sequence, timeout=5.0):
+                raise TimeoutError("Fake camera delivered no frame")
+            return self.latest
+
+    # Capture
+
+    def capture_request(self):
+        request = self.wait_for_request()
+        request.acquire()
+        return request
+
+    def capture_array(self, name="main"):
+        return self.wait_for_request().make_array(name)
+
+    def capture_metadata(self):
+        return self.wait_for_request().get_metadata()
+
+    def switch_mode(self, camera_config):
+        """Emulate reconfiguring the running camera"""
+        self.stop()
+        time.sleep(self.frame_duration * 4)
+        self.configure(camera_config)
+        self.start()
+
+    def switch_mode_and_capture_request(self, camera_config):
+        """Emulate a mode switch: the stream pauses for a few frames"""
+        previous = self.config
+        self.stop()
+        time.sleep(self.frame_duration * 4)
+        self.configure(camera_config)
+        frame = self.frames[self.frame_index % len(self.frames)]
+        request = ReplayRequest(self, camera_config, frame, time.monotonic_ns())
+        self.configure(previous)
+        self.start()
+        return request
+
+    # Controls and encoders
+
+    def auto_exposure(self):
+        """Exposure time (us) the fake auto exposure settles on"""
+        return int(self.frame_duration * 1e6 * 0.8)
+
+    def exposure_time(self):
+        # As on libcamera, an ExposureTime of 0 leaves it to auto exposure
+        if self.controls.get("AeEnable", True) is False and self.controls.get("ExposureTime"):
+            return int(self.controls["ExposureTime"])
+        return self.auto_exposure()
+
+    def set_controls(self, controls):
+        self.controls.update(controls)
+        if "FrameRate" in controls:
+            self.frame_duration = 1.0 / controls["FrameRate"]
+        elif "FrameDurationLimits" in controls:
+            self.frame_duration = controls["FrameDurationLimits"][0] / 1e6
+
+    def start_encoder(self, encoder, output=None, quality=None, **kwargs):
+        # There is no hardware encoder to drive; just track the state
+        print("Fake camera: encoder started, no video will be written")
+        self.encoder = encoder
+        self.output = output
+
+    def stop_encoder(self, encoders=None):
+        self.encoder = None
+        self.output = None
@@ -0,0 +1,259 @@
+import io
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+from PIL import Image
+
+from processing import SHARPEN_SIGMA, AdjustmentEngine, TileProcessor
+
+
+class ZslRing:
+    """Keeps the most recent full resolution requests for zero shutter lag.
+
+    Each completed request is acquired as it arrives and the oldest one is
+    released once more than `depth` are held. `depth` must stay below the
+    configuration's buffer_count, or the camera runs out of buffers.
+    """
+
+    def __init__(self, depth):
+        self.depth = depth
+        self.requests = deque()  # (sensor timestamp ns, request), oldest first
+        self.lock = threading.Lock()
+
+    def push(self, request, timestamp):
+        request.acquire()
+        with self.lock:
+            self.requests.append((timestamp, request))
+            stale = self.requests.popleft()[1] if len(self.requests) > self.depth else None
+        if stale is not None:
+            stale.release()
+
+    def take_closest(self, timestamp):
+        """Acquire the request captured closest to `timestamp` (ns)
+
+        Returns (request, its timestamp), or (None, None) if the ring is
+        empty. The caller owns the extra reference and must release it.
+        """
+        with self.lock:
+            if not self.requests:
+                return None, None
+            closest, request = min(self.requests, key=lambda item: abs(item[0] - timestamp))
+            request.acquire()
+            return request, closest
+
+    def clear(self):
+        with self.lock:
+            held = [request for _, request in self.requests]
+            self.requests.clear()
+        for request in held:
+            request.release()
+
+
+class StillWriter:
+    """Bounded queue that encodes and writes stills on a dedicated pool.
+
+    The capture path reserves the frame's size against a memory budget
+    before copying it out of the camera request, so the request can be
+    released immediately. When a reservation doesn't fit, the caller has to
+    wait (backpressure); on_capacity(bool) reports whether another frame of
+    the last seen size would fit, e.g. to grey out the shutter button.
+    Encoded files are written through `storage`, a StorageWriter.
+    """
+
+    def __init__(self, storage, workers=2, budget=128 * 1024 * 1024, quality=90, on_capacity=None):
+        self.storage = storage
+        self.budget = budget
+        self.quality = quality
+        self.on_capacity = on_capacity
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="still")
+
+        self.lock = threading.Lock()
+        self.in_flight = 0  # Reserved bytes
+        self.frame_size = 0  # Largest reservation seen, for on_capacity
+        self.has_room = True
+
+    def reserve(self, nbytes):
+        """Claim `nbytes` of the budget; returns False if it doesn't fit"""
+        with self.lock:
+            # A single frame larger than the budget is let through on its own
+            if self.in_flight and self.in_flight + nbytes > self.budget:
+                return False
+            self.in_flight += nbytes
+            self.frame_size = max(self.frame_size, nbytes)
+        self.update_capacity()
+        return True
+
+    def unreserve(self, nbytes):
+        with self.lock:
+            self.in_flight -= nbytes
+        self.update_capacity()
+
+    def update_capacity(self):
+        with self.lock:
+            room = not self.in_flight or self.in_flight + self.frame_size <= self.budget
+            changed = room != self.has_room
+            self.has_room = room
+        if changed and self.on_capacity:
+            self.on_capacity(room)
+
+    def submit(self, image, path, nbytes, process=None, on_done=None):
+        """Queue a copied-out frame for processing, encoding and writing
+
+        `nbytes` must have been reserved; it is given back once the frame
+        is encoded. The returned future resolves once the file is on disk,
+        and on_done(path, error) runs right after, on a worker or storage
+        thread.
+        """
+        done = Future()
+        self.executor.submit(self.write, image, path, nbytes, process, on_done, done)
+        return done
+
+    def write(self, image, path, nbytes, process, on_done, done):
+        try:
+            if process:
+                image = process(image)
+            buffer = io.BytesIO()
+            Image.fromarray(image).save(buffer, format="JPEG", quality=self.quality)
+        except Exception as e:
+            self.written(path, e, on_done, done)
+            return
+        finally:
+            self.unreserve(nbytes)
+
+        written = self.storage.write_file(path, buffer.getbuffer())
+        written.add_done_callback(lambda f: self.written(path, f.exception(), on_done, done))
+
+    def written(self, path, error, on_done, done):
+        if error:
+            print(f"Error saving {path}: {error}")
+            done.set_exception(error)
+        else:
+            done.set_result(path)
+        if on_done:
+            on_done(path, error)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+# Per-process tile processor for burst workers, created on first use
+_tile_processor = None
+
+
+def encode_shared_frame(shm_name, shape, quality, params, sigma):
+    """Burst worker: adjust and encode a frame held in shared memory
+
+    Runs in a pool process and returns the JPEG bytes, which the app writes
+    through its storage queue. `params` are the AdjustmentEngine values, or
+    None to save the frame as the ISP produced it. The frame is adjusted in
+    place, tile by tile, so each worker only needs a little scratch memory.
+    """
+    global _tile_processor
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        image = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+        if params is not None:
+            if _tile_processor is None:
+                # The pool already spreads frames over the cores. A 12 MP
+                # frame sharpened at the preview's look needs up to 28 MB
+                _tile_processor = TileProcessor(budget=32 * 1024 * 1024, workers=1)
+            engine = AdjustmentEngine()
+            engine.set_params(*params)
+            try:
+                _tile_processor.process(image, engine, sigma)
+            except MemoryError as e:
+                print(f"Error in burst image processing: {e}")
+        buffer = io.BytesIO()
+        Image.fromarray(image).save(buffer, format="JPEG", quality=quality)
+        del image  # Drop the view before closing the mapping
+    finally:
+        shm.close()
+    return buffer.getvalue()
+
+
+class BurstWriter:
+    """Encodes burst frames on a multi-process pool via shared memory slots.
+
+    A fixed set of shared memory slots, each the size of one frame, is the
+    burst buffer: the capture loop copies each frame into a free slot and
+    hands the slot's name to a worker process, so no pixel data is pickled.
+    When every slot is busy the capture loop has to wait, which is where
+    the burst starts throttling. Encoded files are written through
+    `storage`, a StorageWriter.
+    """
+
+    def __init__(self, storage, shape, slots, workers=None, quality=90):
+        self.storage = storage
+        self.shape = shape
+        self.quality = quality
+        nbytes = int(np.prod(shape))
+        self.slots = [shared_memory.SharedMemory(create=True, size=nbytes) for _ in range(slots)]
+        self.free = queue.Queue()
+        for slot in self.slots:
+            self.free.put(slot)
+
+        # The app is multi-threaded (GTK, camera), so don't fork it
+        self.pool = ProcessPoolExecutor(
+            max_workers=workers or os.cpu_count(),
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+
+    def acquire_slot(self, timeout=None):
+        """Get a free slot, waiting up to `timeout`; returns None on timeout"""
+        try:
+            if timeout == 0:
+                return self.free.get_nowait()
+            return self.free.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def release_slot(self, slot):
+        """Return a slot that was acquired but never submitted"""
+        self.free.put(slot)
+
+    def slot_array(self, slot):
+        return np.ndarray(self.shape, dtype=np.uint8, buffer=slot.buf)
+
+    def submit(self, slot, path, params, sigma=SHARPEN_SIGMA):
+        """Encode the frame in `slot`; the slot is freed once it's encoded
+
+        Returns a future that resolves once the file is written.
+        """
+        future = self.pool.submit(
+            encode_shared_frame, slot.name, self.shape, self.quality, params, sigma
+        )
+        future.add_done_callback(lambda _: self.free.put(slot))
+        return self.storage.write_result(future, path)
+
+    def shutdown(self):
+        self.pool.shutdown(wait=True)
+        for slot in self.slots:
+            slot.close()
+            slot.unlink()
+
+
+class BurstStats:
+    """Sustained rate and buffer depth of one burst"""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.frames = 0
+        self.depth_before_throttle = None  # Frames taken before the first wait
+
+    def frame_captured(self):
+        self.frames += 1
+
+    def throttled(self):
+        if self.depth_before_throttle is None:
+            self.depth_before_throttle = self.frames
+
+    def fps(self):
+        elapsed = time.monotonic() - self.started
+        return self.frames / elapsed if elapsed > 0 else 0.0
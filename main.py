@@ -1,16 +1,62 @@
 import cv2
 import sys
 import gi
+import itertools
+import json
 import os
+import queue
+import shutil
+import threading
 import time
 import numpy as np
 import glob
 from pathlib import Path
-from picamera2 import Picamera2
 from PIL import Image
 from concurrent.futures import ThreadPoolExecutor
-from picamera2.encoders import H264Encoder, MJPEGEncoder, Quality
-from picamera2.outputs import FfmpegOutput
+from camera_backend import create_camera, mapped_array
+from capture import BurstStats, BurstWriter, StillWriter, ZslRing
+from merge import FrameStacker, HdrMerger, LongExposure
+from processing import (
+    SHARPEN_SIGMA,
+    AdjustmentEngine,
+    StripProcessor,
+    TileProcessor,
+    yuv420_to_rgb,
+)
+from storage import StorageWriter
+from preview import (
+    CpuTimeCounter,
+    FrameMailbox,
+    FrameRing,
+    LatencyHistogram,
+    PreviewScheduler,
+    QualityGovernor,
+    StageProbes,
+)
+from motion import MotionDetector, MotionTrigger
+from recording import (
+    FirstFrameOutput,
+    H264PipeOutput,
+    PrerollOutput,
+    PyAvOutput,
+    RateController,
+    RawH264Output,
+    SegmentedOutput,
+    h264_bitrate,
+    pyav_present,
+    read_playlist,
+    remux_raw,
+    set_encoder_bitrate,
+)
+from timelapse import TimelapseSession, assemble_video, finish_assembly
+from viewfinder import ViewfinderSink
+
+try:
+    from picamera2.encoders import H264Encoder, MJPEGEncoder
+    encoders_present = True
+except ImportError:
+    encoders_present = False
+    print("Picamera2 not found - recording not available")
 
 gi.require_version("Gtk", "4.0")
 gi.require_version("Adw", "1")
@@ -32,10 +78,44 @@ class CameraApp(Adw.Application):
         self.picam2 = None
         self.capture_config = None
         self.record_config = None
+        self.zsl_config = None
+        self.zsl_ring = None
         self.viewfinder_widget = None
+        self.preview_status_label = None
+        self.preview_stats_label = None
+        self.capture_progress = None
+        self.viewfinder_sink = None
+        self.frame_ring = None
+        self.frame_mailbox = None
         self.capture_button = None
+        self.capture_mode_dropdown = None
         self.record_button = None
         self.recording = False
+        self.record_fps = 30  # Frame rate of the recording stream
+        self.preroll_label = None
+
+        # How recordings are written: "pyav" muxes MP4 in process, "ffmpeg"
+        # pipes through an ffmpeg process and "raw" writes .h264 plus a
+        # timestamp file, remuxed to MP4 after the take
+        self.record_backend = os.environ.get(
+            "PITA_RECORD_BACKEND", "pyav" if pyav_present else "ffmpeg"
+        )
+        if self.record_backend == "pyav" and not pyav_present:
+            print("PyAV not found - recording through ffmpeg")
+            self.record_backend = "ffmpeg"
+        self.record_output = None
+        # Button press to first frame written, per backend
+        self.record_latency = {}
+        # Long takes split into files of at most this long or this large,
+        # tied together by an .m3u playlist; 0 and 0 record one file
+        self.segment_seconds = float(os.environ.get("PITA_SEGMENT_SECONDS", "0"))
+        self.segment_max_bytes = int(os.environ.get("PITA_SEGMENT_MB", "0")) * 1024 * 1024
+
+        # Pre-roll: the encoder runs all the time into a memory buffer, and
+        # recordings start with what it holds
+        self.preroll_seconds = float(os.environ.get("PITA_PREROLL_SECONDS", "0"))
+        self.preroll_max_bytes = int(os.environ.get("PITA_PREROLL_MB", "32")) * 1024 * 1024
+        self.preroll_output = None
 
         # Slider widgets
         self.saturation_slider = None
@@ -62,17 +142,136 @@ class CameraApp(Adw.Application):
         # Video playback
         self.video_pipeline = None
         self.is_playing_video = False
+        self.video_queue = []  # Segments still to play after the current one
+
+        # Preview pacing
+        self.preview_fps = 30.0
+        self.preview_scheduler = PreviewScheduler(self.preview_fps)
+        self.preview_frame_ready = threading.Event()
+        self.preview_yuv = None
+        self.quality_governor = QualityGovernor(1.0 / self.preview_fps)
+        self.half_frame = None  # Scratch buffer for the half resolution tier
+        self.preview_timestamp = 0.0
+
+        # Per-stage latency probes, off unless asked for
+        self.probes = StageProbes(enabled=os.environ.get("PITA_PROBES") == "1")
+        self.probes_overlay = os.environ.get("PITA_PROBES_OVERLAY") == "1"
+        self.probes_json = os.environ.get("PITA_PROBES_JSON")
+        self.frame_times = {}  # Ring index -> (sensor timestamp, time posted)
 
         self.running = False
         self.executor = ThreadPoolExecutor(
             max_workers=2
         )  # One for preview, one for captures
 
+        # Zero shutter lag: stream full resolution continuously and save the
+        # buffered frame closest to the button press, with no mode switch
+        self.zsl_enabled = os.environ.get("PITA_ZSL") == "1"
+        self.zsl_buffer_count = 5
+
+        # Every file the app saves is written behind through one queue with
+        # a memory cap, in large chunks, fsynced as PITA_STORAGE_FSYNC says
+        self.storage = StorageWriter(
+            budget=int(os.environ.get("PITA_STORAGE_BUFFER_MB", "64")) * 1024 * 1024,
+            fsync=os.environ.get("PITA_STORAGE_FSYNC", "interval"),
+            fsync_bytes=int(os.environ.get("PITA_STORAGE_FSYNC_MB", "8")) * 1024 * 1024,
+        )
+        self.storage_label = None
+        self.storage_timer = 0
+        # Written and synced at startup to learn how fast the card is; 0 skips it
+        self.storage_benchmark_bytes = int(os.environ.get("PITA_STORAGE_BENCHMARK_MB", "8")) * 1024 * 1024
+
+        # The recording bitrate follows what the card keeps up with
+        self.rate_controller = None
+        self.record_encoder = None
+        self.record_name = None
+        self.preroll_encoder = None
+
+        # Stills are encoded and written on their own pool, with a cap on
+        # the memory held by frames waiting for it
+        self.still_writer = StillWriter(
+            self.storage, workers=2, budget=128 * 1024 * 1024, on_capacity=self.on_still_capacity
+        )
+        self.capture_sequence = itertools.count(1)
+
+        # Burst capture; the encoder processes are started on the first burst
+        self.burst_frames = int(os.environ.get("PITA_BURST_FRAMES", "10"))
+        self.burst_writer = None
+        self.burst_running = False
+        self.burst_stop = threading.Event()
+
+        # HDR brackets, merged in a background process as they are captured
+        self.hdr_frames = int(os.environ.get("PITA_HDR_FRAMES", "3"))
+        self.hdr_stops = float(os.environ.get("PITA_HDR_STOPS", "2.0"))
+        self.hdr_merger = None
+        self.hdr_running = False
+
+        # Multi-frame noise reduction
+        self.stack_frames = int(os.environ.get("PITA_STACK_FRAMES", "8"))
+        self.stack_running = False
+
+        # Long exposure: every frame of the running stream is blended in.
+        # The camera thread hands acquired requests over through the queue
+        self.long_exposure_seconds = float(os.environ.get("PITA_LONG_EXPOSURE_SECONDS", "4"))
+        self.long_exposure_blend = os.environ.get("PITA_LONG_EXPOSURE_BLEND", "mean")
+        self.long_exposure_requests = queue.Queue(maxsize=2)
+        self.long_exposure_active = False
+        self.long_exposure_stop = threading.Event()
+        self.long_exposure_dropped = 0
+
+        # Timelapse, captured from the running stream on its own thread
+        self.timelapse_interval = float(os.environ.get("PITA_TIMELAPSE_INTERVAL", "5"))
+        self.timelapse_frames = int(os.environ.get("PITA_TIMELAPSE_FRAMES", "300"))
+        self.timelapse_fps = int(os.environ.get("PITA_TIMELAPSE_FPS", "25"))
+        self.timelapse = None
+        self.timelapse_stop = threading.Event()
+
+        # Motion-triggered capture, run on the lores preview frames
+        self.motion_action = os.environ.get("PITA_MOTION_ACTION", "record")
+        columns, rows = os.environ.get("PITA_MOTION_GRID", "4x3").split("x")
+        self.motion_grid = (int(columns), int(rows))
+        thresholds = os.environ.get("PITA_MOTION_THRESHOLDS")
+        self.motion_thresholds = [float(t) for t in thresholds.split(",")] if thresholds else None
+        self.motion_sensitivity = int(os.environ.get("PITA_MOTION_SENSITIVITY", "25"))
+        self.motion_cooldown = float(os.environ.get("PITA_MOTION_COOLDOWN", "10"))
+        self.motion_max_clip = float(os.environ.get("PITA_MOTION_MAX_CLIP", "60"))
+        self.motion_detector = None
+        self.motion_trigger = None
+        self.motion_armed = False
+        self.motion_recording = False  # The current recording was started by motion
+
         # Image processing parameters
         self.saturation_value = 1.0
         self.contrast_value = 1.0
         self.sharpness_value = 1.0
         self.brightness_value = 0.0
+        self.adjustments = AdjustmentEngine()
+
+        # Where the slider adjustments are applied, chosen once at startup:
+        # "isp" leaves them to the libcamera ISP only, "software" also
+        # applies them to preview frames and stills
+        self.processing_mode = os.environ.get("PITA_PROCESSING", "software")
+        if self.processing_mode not in ("isp", "software"):
+            print(f"Unknown processing mode {self.processing_mode!r}, using software")
+            self.processing_mode = "software"
+        self.preview_cpu = CpuTimeCounter()
+
+        # Full resolution stills are adjusted tile by tile, with the scratch
+        # memory capped at PITA_STILL_BUDGET_MB
+        self.still_processor = None
+        if self.processing_mode == "software":
+            budget = int(os.environ.get("PITA_STILL_BUDGET_MB", "32")) * 1024 * 1024
+            self.still_processor = TileProcessor(budget=budget)
+
+        # Strip-parallel preview processing; 1 keeps the single-threaded path
+        self.preview_workers = int(os.environ.get("PITA_PREVIEW_WORKERS", "1"))
+        self.strip_processor = None
+        if self.processing_mode == "isp":
+            self.process_preview_frame = self.process_preview_frame_isp
+        else:
+            if self.preview_workers > 1:
+                self.strip_processor = StripProcessor(self.adjustments, self.preview_workers)
+            self.process_preview_frame = self.process_preview_frame_software
 
     def on_activate(self, app):
         builder = Gtk.Builder()
@@ -87,10 +286,17 @@ class CameraApp(Adw.Application):
         
         # Camera view widgets
         self.viewfinder_widget = builder.get_object("viewfinder")
+        self.preview_status_label = builder.get_object("preview_status")
+        self.preview_stats_label = builder.get_object("preview_stats")
+        self.capture_progress = builder.get_object("capture_progress")
+        self.preroll_label = builder.get_object("preroll_status")
+        self.storage_label = builder.get_object("storage_status")
         self.capture_button = builder.get_object("capture_button")
         self.capture_button.connect("clicked", self.on_capture_clicked)
+        self.capture_mode_dropdown = builder.get_object("capture_mode")
         self.record_button = builder.get_object("record_button")
         self.record_button.connect("toggled", self.on_record_button_toggled)
+        self.record_button.set_sensitive(encoders_present)
         
         # Gallery button
         self.gallery_button = builder.get_object("gallery_button")
@@ -202,7 +408,9 @@ class CameraApp(Adw.Application):
             # Get all jpg and mp4 files, sorted by modification time (newest first)
             jpg_files = list(captures_dir.glob("*.jpg"))
             mp4_files = list(captures_dir.glob("*.mp4"))
-            all_files = jpg_files + mp4_files
+            # Segmented recordings show up once, as their playlist
+            playlists = list(captures_dir.glob("*.m3u"))
+            all_files = jpg_files + mp4_files + playlists
             all_files.sort(key=lambda x: x.stat().st_mtime, reverse=True)
             self.media_files = [str(f) for f in all_files]
 
@@ -262,6 +470,8 @@ class CameraApp(Adw.Application):
     def extract_video_thumbnail(self, video_path):
         """Extract first frame from video as thumbnail"""
         try:
+            if video_path.endswith(".m3u"):
+                video_path = read_playlist(video_path)[0]
             cap = cv2.VideoCapture(video_path)
             ret, frame = cap.read()
             cap.release()
@@ -361,14 +571,21 @@ class CameraApp(Adw.Application):
                 # Add the video widget to the same parent as the image
                 parent.append(self.fullscreen_video)
             
-            # Set video file and show widget
-            video_file = Gio.File.new_for_path(os.path.abspath(video_path))
-            self.fullscreen_video.set_file(video_file)
-            self.fullscreen_video.set_visible(True)
-            
+            # A segmented recording plays its parts one after another
+            if video_path.endswith(".m3u"):
+                self.video_queue = read_playlist(video_path)
+                if not self.video_queue:
+                    raise ValueError("The recording has no finished segment yet")
+            else:
+                self.video_queue = [video_path]
+
             # Set autoplay
             self.fullscreen_video.set_autoplay(True)
             self.fullscreen_video.set_loop(False)
+
+            # Set video file and show widget
+            self.play_next_segment()
+            self.fullscreen_video.set_visible(True)
             
             self.is_playing_video = True
             
@@ -403,6 +620,17 @@ class CameraApp(Adw.Application):
                 self.fullscreen_image.set_visible(True)
                 self.is_playing_video = False
 
+    def play_next_segment(self):
+        video_file = Gio.File.new_for_path(os.path.abspath(self.video_queue.pop(0)))
+        self.fullscreen_video.set_file(video_file)
+        if self.video_queue:
+            stream = self.fullscreen_video.get_media_stream()
+            stream.connect("notify::ended", self.on_segment_ended)
+
+    def on_segment_ended(self, stream, pspec):
+        if stream.get_ended() and self.is_playing_video and self.video_queue:
+            self.play_next_segment()
+
     def stop_video_playback(self):
         """Stop video playback and clean up"""
         if hasattr(self, 'fullscreen_video') and self.fullscreen_video and self.is_playing_video:
@@ -470,6 +698,13 @@ class CameraApp(Adw.Application):
                 self.stop_video_playback()
                 
                 # Delete the file
+                if file_path.endswith(".m3u"):
+                    # And the directory of segments it plays
+                    shutil.rmtree(os.path.splitext(file_path)[0], ignore_errors=True)
+                # And the encoding log of a recording
+                log_path = os.path.splitext(file_path)[0] + ".json"
+                if os.path.exists(log_path):
+                    os.remove(log_path)
                 os.remove(file_path)
                 self.show_toast(f"Deleted {os.path.basename(file_path)}")
                 
@@ -497,21 +732,25 @@ class CameraApp(Adw.Application):
     def on_saturation_changed(self, slider):
         # Convert from 0-200 range to 0-2.0 range
         self.saturation_value = slider.get_value() / 100.0
+        self.update_adjustments()
         self.update_camera_controls()
 
     def on_contrast_changed(self, slider):
         # Convert from 0-200 range to 0-2.0 range
         self.contrast_value = slider.get_value() / 100.0
+        self.update_adjustments()
         self.update_camera_controls()
 
     def on_sharpness_changed(self, slider):
         # Convert from 0-200 range to 0-2.0 range
         self.sharpness_value = slider.get_value() / 100.0
+        self.update_adjustments()
         self.update_camera_controls()
 
     def on_brightness_changed(self, slider):
         # Convert from 0-200 range to -1.0 to 1.0 range
         self.brightness_value = (slider.get_value() - 100.0) / 100.0
+        self.update_adjustments()
         self.update_camera_controls()
 
     def update_camera_controls(self):
@@ -528,42 +767,27 @@ class CameraApp(Adw.Application):
             except Exception as e:
                 print(f"Error setting camera controls: {e}")
 
-    def apply_image_processing(self, image):
+    def update_adjustments(self):
+        """Push slider values to the preview adjustment engine"""
+        self.adjustments.set_params(
+            self.brightness_value,
+            self.contrast_value,
+            self.saturation_value,
+            self.sharpness_value,
+        )
+
+    def apply_image_processing(self, image, out=None, sharpen=True):
         """Apply additional image processing effects"""
         try:
-            # Convert to float for processing
-            img_float = image.astype(np.float32) / 255.0
-            
-            # Apply brightness (additive)
-            img_float = img_float + (self.brightness_value * 0.3)  # Scale down brightness effect
-            
-            # Apply contrast (multiplicative around 0.5)
-            img_float = ((img_float - 0.5) * self.contrast_value) + 0.5
-            
-            # Apply saturation
-            if self.saturation_value != 1.0:
-                # Convert to HSV for saturation adjustment
-                hsv = cv2.cvtColor(img_float, cv2.COLOR_RGB2HSV)
-                hsv[:,:,1] = hsv[:,:,1] * self.saturation_value
-                img_float = cv2.cvtColor(hsv, cv2.COLOR_HSV2RGB)
-            
-            # Apply sharpness using unsharp mask
-            if self.sharpness_value != 1.0:
-                gaussian = cv2.GaussianBlur(img_float, (0, 0), 2.0)
-                img_float = cv2.addWeighted(img_float, self.sharpness_value, 
-                                          gaussian, -(self.sharpness_value - 1.0), 0)
-            
-            # Clip values and convert back to uint8
-            img_float = np.clip(img_float, 0, 1)
-            return (img_float * 255).astype(np.uint8)
-            
+            return self.adjustments.apply(image, out, sharpen)
         except Exception as e:
             print(f"Error in image processing: {e}")
             return image
 
     def setup_camera(self):
         try:
-            self.picam2 = Picamera2()
+            # PITA_CAMERA=fake[:frames.yuv] replays frames without a Pi camera
+            self.picam2 = create_camera(os.environ.get("PITA_CAMERA"))
 
             self.record_config = self.picam2.create_video_configuration(
                 main={
@@ -585,14 +809,55 @@ class CameraApp(Adw.Application):
                 display=None,
             )
 
-            self.picam2.configure(self.record_config)
+            if self.zsl_enabled:
+                self.zsl_config = self.picam2.create_still_configuration(
+                    main={"size": self.picam2.sensor_resolution, "format": "BGR888"},
+                    lores={"size": (640, 480)},
+                    display="lores",
+                    buffer_count=self.zsl_buffer_count,
+                )
+                # Two buffers stay with the camera so it never stalls
+                self.zsl_ring = ZslRing(self.zsl_buffer_count - 2)
+                # The full resolution stream can't be H.264 encoded
+                self.record_button.set_sensitive(False)
+                active_config = self.zsl_config
+            else:
+                active_config = self.record_config
+
+            self.picam2.configure(active_config)
             self.picam2.start()
 
+            # Preallocated viewfinder buffers, wrapped as textures without copying
+            width, height = active_config["lores"]["size"]
+            self.frame_ring = FrameRing(width, height)
+            self.half_frame = np.empty((height // 2, width // 2, 3), dtype=np.uint8)
+            self.viewfinder_sink = ViewfinderSink(self.viewfinder_widget, self.frame_ring)
+            self.frame_mailbox = FrameMailbox(on_drop=self.frame_ring.release)
+
+            # Every completed request is offered to the preview scheduler
+            self.picam2.post_callback = self.on_camera_request
+
             # Set initial camera controls
             self.update_camera_controls()
 
+            if self.probes.enabled:
+                if self.probes_overlay:
+                    self.preview_stats_label.set_visible(True)
+                    GLib.timeout_add(1000, self.update_preview_stats)
+                if self.probes_json:
+                    GLib.timeout_add_seconds(10, self.dump_preview_stats)
+
+            if self.preroll_seconds > 0 and encoders_present and not self.zsl_enabled:
+                self.start_preroll()
+
             self.running = True
             self.executor.submit(self.camera_preview_loop)
+            self.resume_timelapses()
+
+            if self.storage_benchmark_bytes:
+                os.makedirs("captures", exist_ok=True)
+                benchmark = self.storage.benchmark("captures", self.storage_benchmark_bytes)
+                benchmark.add_done_callback(self.on_storage_benchmark)
 
             print("Camera initialized successfully")
 
@@ -600,35 +865,73 @@ class CameraApp(Adw.Application):
             print(f"Failed to initialize camera: {e}")
             self.show_error_dialog(f"Camera Error: {e}")
 
+    def on_camera_request(self, request):
+        """Runs in the camera thread for every completed request"""
+        try:
+            # Only update camera preview when on camera view
+            current_view = self.main_stack.get_visible_child_name() if self.main_stack else "camera"
+            if current_view != "camera" and not self.motion_armed:
+                return
+
+            metadata = request.get_metadata()
+            timestamp_ns = metadata.get("SensorTimestamp", time.monotonic_ns())
+            if self.zsl_ring:
+                self.zsl_ring.push(request, timestamp_ns)
+
+            if self.long_exposure_active:
+                # Every frame goes to the blend; the viewfinder shows the
+                # blend instead of the live stream meanwhile
+                request.acquire()
+                try:
+                    self.long_exposure_requests.put_nowait(request)
+                except queue.Full:
+                    request.release()
+                    self.long_exposure_dropped += 1
+                return
+
+            timestamp = timestamp_ns / 1e9
+            if not self.preview_scheduler.offer(timestamp):
+                return
+
+            started = self.probes.start()
+            self.preview_yuv = request.make_array("lores")
+            self.preview_timestamp = timestamp
+            self.probes.stop("capture", started)
+            self.preview_frame_ready.set()
+        except Exception as e:
+            print(f"Camera request error: {e}")
+
     def camera_preview_loop(self):
         """Background thread for updating the preview"""
         while self.running:
+            if not self.preview_frame_ready.wait(0.1):
+                continue
+            self.preview_frame_ready.clear()
+
+            index = None
             try:
-                # Only update camera preview when on camera view
-                current_view = self.main_stack.get_visible_child_name() if self.main_stack else "camera"
-                if current_view != "camera":
-                    time.sleep(0.1)
+                yuv_array = self.preview_yuv
+                timestamp = self.preview_timestamp
+                if self.motion_armed:
+                    self.check_motion(yuv_array)
+
+                index = self.frame_ring.acquire()
+                if index is None:
+                    # GTK still holds every buffer, drop this frame
                     continue
-                    
-                yuv_array = self.picam2.capture_array("lores")
+                frame = self.frame_ring.buffers[index]
 
-                # Convert YUV420 to RGB using OpenCV
-                rgb_array = cv2.cvtColor(yuv_array, cv2.COLOR_YUV2RGB_I420)
-                
-                # Apply additional image processing effects
-                rgb_array = self.apply_image_processing(rgb_array)
+                start = time.perf_counter()
+                cpu_start = time.thread_time()
+                self.process_preview_frame(yuv_array, frame)
+                cpu_time = time.thread_time() - cpu_start
+                if self.strip_processor:
+                    cpu_time += self.strip_processor.last_cpu_time
+                self.preview_cpu.add(cpu_time)
 
-                # Create GdkPixbuf directly from RGB array
-                height, width, channels = rgb_array.shape
-                pixbuf = GdkPixbuf.Pixbuf.new_from_data(
-                    rgb_array.tobytes(),
-                    GdkPixbuf.Colorspace.RGB,
-                    False,
-                    8,
-                    640,
-                    480,
-                    640 * 3,
-                )
+                tier = self.quality_governor.update(time.perf_counter() - start)
+                if tier is not None:
+                    self.on_quality_tier_changed(tier)
 
                 if self.recording:
                     elapsed = int(time.time() - self.recording_start_time)
@@ -638,26 +941,200 @@ class CameraApp(Adw.Application):
 
                     self.record_button.get_child().set_text(timer_text)
 
-                # Push frame to UI
-                GLib.idle_add(self.update_picture_widget, pixbuf)
+                if self.probes.enabled:
+                    self.frame_times[index] = (timestamp, time.monotonic())
 
-                time.sleep(1 / 30.0)  # ~30 FPS
+                # Push frame to UI, replacing any frame not shown yet
+                if self.frame_mailbox.post(index):
+                    GLib.idle_add(self.update_picture_widget)
+                index = None  # Owned by the mailbox now
             except Exception as e:
                 print(f"Camera loop error: {e}")
-                time.sleep(0.1)
+                if index is not None:
+                    self.frame_ring.release(index)
+            finally:
+                self.preview_scheduler.finish()
+
+    def process_preview_frame_isp(self, yuv_array, frame):
+        """Adjustments come from the ISP, only convert for display"""
+        started = self.probes.start()
+        yuv420_to_rgb(yuv_array, frame)
+        self.probes.stop("convert", started)
+
+    def process_preview_frame_software(self, yuv_array, frame):
+        tier = self.quality_governor.tier
+        sharpen = tier == QualityGovernor.FULL
+
+        if tier >= QualityGovernor.HALF_RES:
+            started = self.probes.start()
+            yuv420_to_rgb(yuv_array, frame)
+            self.probes.stop("convert", started)
+
+            # Adjust a half size copy and scale it back up
+            started = self.probes.start()
+            half = self.half_frame
+            height, width = half.shape[:2]
+            cv2.resize(frame, (width, height), dst=half, interpolation=cv2.INTER_AREA)
+            self.apply_image_processing(half, out=half, sharpen=False)
+            cv2.resize(half, (width * 2, height * 2), dst=frame, interpolation=cv2.INTER_LINEAR)
+            self.probes.stop("adjust", started)
+        elif self.strip_processor:
+            # Convert and adjust strips in parallel into the ring buffer
+            started = self.probes.start()
+            self.strip_processor.process(yuv_array, frame, sharpen)
+            self.probes.stop("strips", started)
+        else:
+            # Convert YUV420 to RGB straight into the ring buffer
+            started = self.probes.start()
+            yuv420_to_rgb(yuv_array, frame)
+            self.probes.stop("convert", started)
+
+            # Apply additional image processing effects in place
+            started = self.probes.start()
+            self.apply_image_processing(frame, out=frame, sharpen=sharpen)
+            self.probes.stop("adjust", started)
+
+    def on_quality_tier_changed(self, tier):
+        """Called from the preview thread when the governor changes tier"""
+        print(f"Preview quality: {self.quality_governor.name()} (tier {tier})")
+        if tier >= QualityGovernor.LOW_FPS:
+            self.preview_scheduler.set_fps(self.preview_fps / 2)
+        else:
+            self.preview_scheduler.set_fps(self.preview_fps)
+        GLib.idle_add(self.update_preview_status)
+
+    def update_preview_status(self):
+        """Show the preview quality tier on the viewfinder while it is degraded"""
+        if self.preview_status_label:
+            tier = self.quality_governor.tier
+            self.preview_status_label.set_text(f"Preview: {self.quality_governor.name()}")
+            self.preview_status_label.set_visible(tier != QualityGovernor.FULL)
+        return False
 
-    def update_picture_widget(self, pixbuf):
-        if self.viewfinder_widget:
-            self.viewfinder_widget.set_pixbuf(pixbuf)
+    def update_picture_widget(self):
+        index = self.frame_mailbox.take()
+        if index is None:
+            return False
+
+        if self.viewfinder_sink:
+            if self.probes.enabled:
+                timestamp, posted = self.frame_times.get(index, (0.0, 0.0))
+                self.probes.record("dispatch", time.monotonic() - posted)
+
+            started = self.probes.start()
+            self.viewfinder_sink.show(index)
+            self.probes.stop("texture", started)
+
+            if self.probes.enabled:
+                # Sensor exposure to the frame being handed to GTK
+                self.probes.record("display", time.monotonic() - timestamp)
+
+            if self.frame_ring.frames_displayed % 300 == 0:
+                fps, jitter = self.preview_scheduler.stats()
+                print(
+                    f"Viewfinder: {fps:.1f} fps (target {self.preview_fps:.0f}), "
+                    f"jitter {jitter:.1f} ms, "
+                    f"{self.preview_cpu.mean_ms():.1f} ms CPU per frame ({self.processing_mode}), "
+                    f"{self.frame_ring.bytes_copied_per_frame():.0f} bytes copied per frame, "
+                    f"{self.frame_mailbox.dropped} stale frames dropped"
+                )
+        else:
+            self.frame_ring.release(index)
         return False
 
+    def update_preview_stats(self):
+        """Refresh the on-screen latency overlay"""
+        if self.preview_stats_label:
+            self.preview_stats_label.set_text(self.probes.format())
+        return self.running
+
+    def dump_preview_stats(self):
+        """Periodically write the latency histograms as JSON"""
+        try:
+            self.probes.dump(self.probes_json)
+        except Exception as e:
+            print(f"Error writing preview stats: {e}")
+        return self.running
+
+    def get_capture_mode(self):
+        item = self.capture_mode_dropdown.get_selected_item()
+        return item.get_string() if item else "Single"
+
     def on_capture_clicked(self, button):
         print("Capture button clicked")
-        GLib.idle_add(self.show_toast, "Image captured successfully!")
 
-        self.executor.submit(self.capture_image)
+        mode = self.get_capture_mode()
+        busy = (
+            self.burst_running or self.hdr_running or self.stack_running
+            or self.long_exposure_active or self.timelapse is not None
+            or self.motion_armed
+        )
+        if mode == "Burst" and self.burst_running:
+            # A second press ends the burst early
+            self.burst_stop.set()
+        elif mode == "Long exposure" and self.long_exposure_active:
+            # A second press ends the exposure early
+            self.long_exposure_stop.set()
+        elif mode == "Timelapse" and self.timelapse is not None:
+            # A second press ends the sequence and assembles what we have
+            self.timelapse_stop.set()
+        elif mode == "Motion" and self.motion_armed:
+            self.disarm_motion()
+        elif busy:
+            self.show_toast("Capture in progress")
+        elif mode == "Burst":
+            self.burst_running = True
+            self.burst_stop.clear()
+            self.executor.submit(self.capture_burst)
+        elif mode == "HDR":
+            self.hdr_running = True
+            self.executor.submit(self.capture_hdr)
+        elif mode == "Stack":
+            self.stack_running = True
+            self.executor.submit(self.capture_stack)
+        elif mode == "Long exposure" and self.zsl_ring:
+            # The ring already holds all the buffers the blend would need,
+            # and a full resolution accumulator alone takes ~150 MB
+            self.show_toast("Long exposure isn't available with zero shutter lag")
+        elif mode == "Long exposure":
+            self.long_exposure_active = True
+            self.long_exposure_stop.clear()
+            self.executor.submit(self.capture_long_exposure)
+        elif mode == "Motion":
+            self.arm_motion()
+        elif mode == "Timelapse":
+            os.makedirs("captures", exist_ok=True)
+            self.start_timelapse(
+                TimelapseSession.create(
+                    "captures", self.timelapse_interval, self.timelapse_frames,
+                    self.timelapse_fps, self.storage,
+                )
+            )
+        elif self.zsl_ring:
+            self.executor.submit(self.capture_zsl_image, time.monotonic_ns())
+        else:
+            self.executor.submit(self.capture_image)
+
+    def on_still_capacity(self, has_room):
+        """Grey out the shutter while the still queue is full"""
+        GLib.idle_add(self.capture_button.set_sensitive, has_room)
+
+    def on_storage_benchmark(self, future):
+        """Runs on the storage thread once the startup benchmark is done"""
+        if future.exception() is not None:
+            print(f"Storage benchmark failed: {future.exception()}")
+            return
+        print(f"Storage: captures/ takes {future.result() / 1e6:.1f} MB/s")
+
+    def on_still_saved(self, path, error):
+        """Runs on a still writer thread once the file is on disk (or failed)"""
+        if error:
+            GLib.idle_add(self.show_toast, f"Error saving image: {error}")
+        else:
+            GLib.idle_add(self.show_toast, "Image captured successfully!")
 
     def on_record_button_toggled(self, button):
+        pressed = time.monotonic()
         style_context = button.get_style_context()
         label = button.get_child()  # Get the GtkLabel child
 
@@ -674,19 +1151,52 @@ class CameraApp(Adw.Application):
             label.set_attributes(attr_list)
 
             self.recording_start_time = time.time()
-
-            output = FfmpegOutput(
-                self.get_capture_filename() + ".mp4", audio=False
-            )
+            name = self.get_capture_filename()
+            self.record_name = name
+            segmented = self.segment_seconds > 0 or self.segment_max_bytes > 0
+            if segmented:
+                output = self.create_segmented_output(name)
+                path = output.playlist_path
+            else:
+                path = name + ".mp4"
+                output = self.create_record_output(path)
 
             # Update camera controls before recording
             self.update_camera_controls()
 
-            # For HD and lower
-            self.picam2.start_encoder(
-                H264Encoder(), output, quality=Quality.VERY_HIGH
+            self.rate_controller = RateController(
+                self.record_config["main"]["size"], self.record_fps, self.storage.card_rate()
+            )
+            bitrate = self.rate_controller.bitrate
+            warning = self.storage.slow_card_warning(bitrate / 8)
+            if warning:
+                print(warning)
+                self.show_toast(warning)
+            self.storage_label.set_visible(True)
+            if not self.storage_timer:
+                self.storage_timer = GLib.timeout_add(1000, self.update_storage_status)
+
+            self.record_output = FirstFrameOutput(
+                output, lambda: self.on_first_record_frame(pressed)
+            )
+            if self.preroll_output:
+                # The encoder is already running; start with the buffered video
+                self.record_encoder = self.preroll_encoder
+                set_encoder_bitrate(self.record_encoder, bitrate)
+                self.preroll_output.start_recording(self.record_output)
+            else:
+                # Segments can only start on a keyframe that carries its headers
+                if segmented:
+                    encoder = H264Encoder(bitrate=bitrate, repeat=True, iperiod=self.record_fps)
+                else:
+                    encoder = H264Encoder(bitrate=bitrate)
+                self.record_encoder = encoder
+                self.picam2.start_encoder(encoder, self.record_output)
+            self.rate_controller.start(time.monotonic())
+            print(
+                f"{path} ({self.record_backend}, {self.rate_controller.tier_name} "
+                f"at {bitrate / 1e6:.1f} Mb/s)"
             )
-            print(self.get_capture_filename() + ".mp4")
 
         else:
 
@@ -703,24 +1213,732 @@ class CameraApp(Adw.Application):
             size_attr = Pango.attr_size_new(32 * Pango.SCALE)
             attr_list.insert(size_attr)
             label.set_attributes(attr_list)
-            self.picam2.stop_encoder()
+            if self.preroll_output:
+                self.preroll_output.stop_recording()
+                # The take may have lowered the shared encoder's bitrate
+                set_encoder_bitrate(
+                    self.preroll_encoder,
+                    h264_bitrate(self.record_config["main"]["size"], self.record_fps),
+                )
+            else:
+                self.picam2.stop_encoder()
+
+            print(f"Recording stopped, storage: {self.storage.format_stats()}")
+            self.write_recording_log()
+            output, self.record_output = self.record_output, None
+            if output and isinstance(output.output, RawH264Output):
+                threading.Thread(
+                    target=self.remux_recording, args=(output.output,), daemon=True
+                ).start()
+
+    def create_record_output(self, path):
+        if self.record_backend == "pyav":
+            size = self.record_config["main"]["size"]
+            return PyAvOutput(path, size, self.record_fps, self.storage)
+        if self.record_backend == "raw":
+            return RawH264Output(path, self.storage)
+        return H264PipeOutput(path, self.record_fps, self.storage)
+
+    def update_storage_status(self):
+        if not self.recording:
+            self.storage_label.set_visible(False)
+            self.storage_timer = 0
+            return False
+        bitrate = self.rate_controller.update(
+            self.storage.stats()["queued"], self.storage.budget, time.monotonic()
+        )
+        if bitrate is not None:
+            applied = set_encoder_bitrate(self.record_encoder, bitrate)
+            reason = self.rate_controller.changes[-1][2]
+            print(
+                f"Recording: {reason}, bitrate to {bitrate / 1e6:.1f} Mb/s"
+                + ("" if applied else " (not applied, the encoder can't change it)")
+            )
+        self.storage_label.set_text(
+            f"Card: {self.storage.format_stats()}, "
+            f"video {self.rate_controller.bitrate / 1e6:.1f} Mb/s"
+        )
+        return True
+
+    def write_recording_log(self):
+        """Save how the recording was encoded next to it, as JSON"""
+        log = {
+            "backend": self.record_backend,
+            "size": list(self.record_config["main"]["size"]),
+            "fps": self.record_fps,
+            "rate": self.rate_controller.to_dict(),
+            "storage": self.storage.stats(),
+        }
+        self.storage.write_file(f"{self.record_name}.json", json.dumps(log, indent=2).encode())
+
+    def create_segmented_output(self, name):
+        """Segments go to the directory `name`, the playlist next to it"""
+        finalize = None
+        if self.record_backend == "raw":
+            finalize = lambda output: remux_raw(output, self.record_fps)
+        return SegmentedOutput(
+            name,
+            name + ".m3u",
+            self.create_record_output,
+            self.storage,
+            self.segment_seconds,
+            self.segment_max_bytes,
+            finalize,
+        )
+
+    def on_first_record_frame(self, pressed):
+        """Runs on the encoder thread when the first frame has been written"""
+        latency = time.monotonic() - pressed
+        histogram = self.record_latency.setdefault(self.record_backend, LatencyHistogram())
+        histogram.add(latency)
+        print(
+            f"Recording ({self.record_backend}): first frame {latency * 1000:.0f} ms "
+            f"after the button, median {histogram.percentile(0.5) * 1000:.0f} ms "
+            f"over {histogram.count()} takes"
+        )
+
+    def remux_recording(self, output):
+        """Background thread: turn a raw recording into its MP4"""
+        if remux_raw(output, self.record_fps):
+            GLib.idle_add(self.show_toast, "Video saved")
+        else:
+            GLib.idle_add(self.show_toast, f"Video kept as {os.path.basename(output.raw_path)}")
+
+    def start_preroll(self):
+        """Run the encoder continuously into the pre-roll buffer"""
+        self.preroll_output = PrerollOutput(self.preroll_seconds, self.preroll_max_bytes)
+        # A keyframe, with its headers, every second gives flushes a clean
+        # start point at most a second before the requested pre-roll
+        # Recordings set their own bitrate when they start
+        bitrate = h264_bitrate(self.record_config["main"]["size"], self.record_fps)
+        self.preroll_encoder = H264Encoder(bitrate=bitrate, repeat=True, iperiod=self.record_fps)
+        self.picam2.start_encoder(self.preroll_encoder, self.preroll_output)
+        self.preroll_label.set_visible(True)
+        GLib.timeout_add(500, self.update_preroll_status)
+        print(
+            f"Pre-roll: buffering {self.preroll_seconds:.1f} s, "
+            f"at most {self.preroll_max_bytes / 1e6:.0f} MB"
+        )
+
+    def pause_preroll(self):
+        """Stop the pre-roll encoder before the main stream changes size"""
+        if self.preroll_encoder:
+            self.picam2.stop_encoder(self.preroll_encoder)
+
+    def resume_preroll(self):
+        """Restart the pre-roll encoder once the record configuration is back
+
+        The buffer keeps what it held; the restarted stream begins with a
+        keyframe, so a recording started later still decodes.
+        """
+        if self.preroll_encoder:
+            self.picam2.start_encoder(self.preroll_encoder, self.preroll_output)
+
+    def update_preroll_status(self):
+        if not self.preroll_output:
+            return False
+        if self.recording:
+            self.preroll_label.set_text("Pre-roll: recording")
+        else:
+            seconds, nbytes = self.preroll_output.buffered()
+            self.preroll_label.set_text(
+                f"Pre-roll: {seconds:.1f} s, {nbytes / 1e6:.1f} of "
+                f"{self.preroll_max_bytes / 1e6:.0f} MB"
+            )
+        return True
 
     def capture_image(self):
         filename = self.get_capture_filename()
+        width, height = self.capture_config["main"]["size"]
+        nbytes = width * height * 3
+        if not self.still_writer.reserve(nbytes):
+            GLib.idle_add(self.show_toast, "Still saving previous images, try again")
+            return
         
         # Update camera controls before capture
         self.update_camera_controls()
         
-        image = self.picam2.switch_mode_and_capture_request(
-            self.capture_config
+        try:
+            self.pause_preroll()
+            try:
+                request = self.picam2.switch_mode_and_capture_request(
+                    self.capture_config
+                )
+            finally:
+                self.resume_preroll()
+            try:
+                # BGR888 main stream, i.e. RGB byte order in numpy. Copying it
+                # out lets the request go back to the camera straight away
+                image = request.make_array("main")
+            finally:
+                request.release()
+        except Exception:
+            self.still_writer.unreserve(nbytes)
+            raise
+
+        self.save_still(image, filename + ".jpg", nbytes)
+
+    def capture_zsl_image(self, pressed):
+        """Save the buffered full resolution frame closest to `pressed` (ns)"""
+        filename = self.get_capture_filename()
+        width, height = self.zsl_config["main"]["size"]
+        nbytes = width * height * 3
+        if not self.still_writer.reserve(nbytes):
+            GLib.idle_add(self.show_toast, "Still saving previous images, try again")
+            return
+
+        request, timestamp = self.zsl_ring.take_closest(pressed)
+        if request is None:
+            print("ZSL: no buffered frame to save")
+            self.still_writer.unreserve(nbytes)
+            return
+        try:
+            image = request.make_array("main")
+        except Exception:
+            self.still_writer.unreserve(nbytes)
+            raise
+        finally:
+            request.release()
+
+        print(f"ZSL: saving frame {(timestamp - pressed) / 1e6:+.1f} ms from the button press")
+        self.save_still(image, filename + ".jpg", nbytes)
+
+    def capture_burst(self):
+        """Grab up to burst_frames full resolution frames as fast as the sensor allows"""
+        zsl = self.zsl_config is not None
+        config = self.zsl_config if zsl else self.capture_config
+        width, height = config["main"]["size"]
+        try:
+            if self.burst_writer is None:
+                slots = max(2, self.still_writer.budget // (width * height * 3))
+                self.burst_writer = BurstWriter(self.storage, (height, width, 3), slots)
+
+            params = None
+            if self.processing_mode == "software":
+                params = (
+                    self.brightness_value,
+                    self.contrast_value,
+                    self.saturation_value,
+                    self.sharpness_value,
+                )
+
+            self.update_camera_controls()
+            stats = BurstStats()
+            futures = []
+            if not zsl:
+                # Stay in the full resolution mode for the whole burst
+                self.pause_preroll()
+                self.picam2.switch_mode(self.capture_config)
+            try:
+                while stats.frames < self.burst_frames and not self.burst_stop.is_set():
+                    slot = self.burst_writer.acquire_slot(timeout=0)
+                    if slot is None:
+                        # Every buffer is waiting on an encoder
+                        stats.throttled()
+                        slot = self.burst_writer.acquire_slot(timeout=5.0)
+                        if slot is None:
+                            print("Burst: encoders stalled, stopping")
+                            break
+
+                    try:
+                        request = self.picam2.capture_request()
+                        try:
+                            np.copyto(self.burst_writer.slot_array(slot), request.make_array("main"))
+                        finally:
+                            request.release()
+                    except Exception:
+                        self.burst_writer.release_slot(slot)
+                        raise
+
+                    stats.frame_captured()
+                    path = self.get_capture_filename() + ".jpg"
+                    futures.append(
+                        self.burst_writer.submit(slot, path, params, self.still_sigma(width))
+                    )
+            finally:
+                if not zsl:
+                    self.picam2.switch_mode(self.record_config)
+                    self.resume_preroll()
+
+            fps = stats.fps()
+            depth = stats.frames if stats.depth_before_throttle is None else stats.depth_before_throttle
+            print(
+                f"Burst: {stats.frames} frames at {fps:.1f} fps sustained, "
+                f"{depth} frames buffered before throttling"
+            )
+
+            failed = sum(1 for future in futures if future.exception() is not None)
+            if failed:
+                GLib.idle_add(self.show_toast, f"Burst: {failed} of {len(futures)} images failed to save")
+            else:
+                GLib.idle_add(self.show_toast, f"Burst saved: {len(futures)} images at {fps:.1f} fps")
+        except Exception as e:
+            print(f"Burst capture error: {e}")
+            GLib.idle_add(self.show_toast, f"Burst failed: {e}")
+        finally:
+            self.burst_running = False
+
+    def capture_hdr(self):
+        """Capture an exposure bracket and merge it as the frames arrive"""
+        zsl = self.zsl_config is not None
+        config = self.zsl_config if zsl else self.capture_config
+        width, height = config["main"]["size"]
+        try:
+            if self.hdr_merger is None:
+                self.hdr_merger = HdrMerger(
+                    self.storage, (height, width, 3), on_progress=self.on_hdr_progress
+                )
+
+            GLib.idle_add(self.show_capture_progress, 0.0, "HDR: metering")
+            self.update_camera_controls()
+            if not zsl:
+                self.pause_preroll()
+                self.picam2.switch_mode(self.capture_config)
+            try:
+                # Bracket around what auto exposure chose, at a fixed gain
+                metadata = self.picam2.capture_metadata()
+                base = metadata["ExposureTime"]
+                count = self.hdr_frames
+                exposures = [
+                    max(int(base * 2.0 ** (self.hdr_stops * (i - (count - 1) / 2))), 1)
+                    for i in range(count)
+                ]
+                print(f"HDR: base exposure {base} us, bracket {exposures}")
+                self.picam2.set_controls(
+                    {"AeEnable": False, "AnalogueGain": metadata["AnalogueGain"]}
+                )
+
+                self.hdr_merger.begin(count)
+                for i, exposure in enumerate(exposures):
+                    self.picam2.set_controls({"ExposureTime": exposure})
+                    request = self.wait_for_exposure(exposure, exposures)
+                    try:
+                        image = request.make_array("main")
+                        actual = request.get_metadata()["ExposureTime"]
+                    finally:
+                        request.release()
+                    # Blocks only while both earlier frames are still merging
+                    self.hdr_merger.add(image, actual / 1e6)
+                    del image
+            finally:
+                # 0 hands shutter and gain back to the auto exposure
+                self.picam2.set_controls({"AeEnable": True, "ExposureTime": 0, "AnalogueGain": 0})
+                if not zsl:
+                    self.picam2.switch_mode(self.record_config)
+                    self.resume_preroll()
+
+            path = self.get_capture_filename() + "_hdr.jpg"
+            self.hdr_merger.finish(path).result()
+            print(f"HDR: saved {path}")
+            GLib.idle_add(self.show_toast, "HDR image saved")
+        except Exception as e:
+            print(f"HDR capture error: {e}")
+            GLib.idle_add(self.show_toast, f"HDR failed: {e}")
+        finally:
+            self.hdr_running = False
+            GLib.idle_add(self.hide_capture_progress)
+
+    def capture_stack(self):
+        """Average several aligned frames into one low-noise still"""
+        zsl = self.zsl_config is not None
+        config = self.zsl_config if zsl else self.capture_config
+        width, height = config["main"]["size"]
+        nbytes = width * height * 3
+        if not self.still_writer.reserve(nbytes):
+            GLib.idle_add(self.show_toast, "Still saving previous images, try again")
+            self.stack_running = False
+            return
+
+        try:
+            self.update_camera_controls()
+            stacker = FrameStacker((height, width, 3))
+            count = min(self.stack_frames, FrameStacker.MAX_FRAMES)
+            GLib.idle_add(self.show_capture_progress, 0.0, f"Stack: 0 of {count}")
+            if not zsl:
+                self.pause_preroll()
+                self.picam2.switch_mode(self.capture_config)
+            try:
+                processing_time = 0.0
+                started = time.perf_counter()
+                for i in range(count):
+                    request = self.picam2.capture_request()
+                    try:
+                        frame_start = time.perf_counter()
+                        shift = stacker.add(request.make_array("main"))
+                        processing_time += time.perf_counter() - frame_start
+                    finally:
+                        request.release()
+                    if shift is None:
+                        print(f"Stack: frame {i + 1} rejected, no match with the first")
+                    GLib.idle_add(
+                        self.show_capture_progress, (i + 1) / count, f"Stack: {i + 1} of {count}"
+                    )
+                elapsed = time.perf_counter() - started
+            finally:
+                if not zsl:
+                    self.picam2.switch_mode(self.record_config)
+                    self.resume_preroll()
+
+            print(
+                f"Stack: {stacker.frames} of {count} frames, "
+                f"{processing_time * 1000.0 / count:.0f} ms aligning and adding "
+                f"and {elapsed * 1000.0 / count:.0f} ms in total per frame"
+            )
+            image = stacker.result()
+            del stacker
+        except Exception as e:
+            self.still_writer.unreserve(nbytes)
+            print(f"Stack capture error: {e}")
+            GLib.idle_add(self.show_toast, f"Stack failed: {e}")
+            return
+        finally:
+            self.stack_running = False
+            GLib.idle_add(self.hide_capture_progress)
+
+        self.save_still(image, self.get_capture_filename() + "_stack.jpg", nbytes)
+
+    def capture_long_exposure(self):
+        """Blend the running stream for long_exposure_seconds into one still"""
+        width, height = self.record_config["main"]["size"]
+        nbytes = width * height * 3
+        if not self.still_writer.reserve(nbytes):
+            GLib.idle_add(self.show_toast, "Still saving previous images, try again")
+            self.long_exposure_active = False
+            return
+
+        exposure = None
+        blend_time = 0.0
+        try:
+            self.update_camera_controls()
+            self.long_exposure_dropped = 0
+            started = time.monotonic()
+            end = started + self.long_exposure_seconds
+            next_render = started
+            while time.monotonic() < end and not self.long_exposure_stop.is_set():
+                try:
+                    request = self.long_exposure_requests.get(timeout=0.5)
+                except queue.Empty:
+                    continue
+                try:
+                    with mapped_array(request, "main") as frame:
+                        if exposure is None:
+                            exposure = LongExposure(frame.shape, self.long_exposure_blend)
+                        blend_start = time.perf_counter()
+                        exposure.add(frame)
+                        blend_time += time.perf_counter() - blend_start
+                finally:
+                    request.release()
+
+                now = time.monotonic()
+                if now >= next_render:
+                    # Show the blend so far a few times a second
+                    next_render = now + 0.25
+                    self.show_long_exposure(exposure)
+                    progress = (now - started) / self.long_exposure_seconds
+                    GLib.idle_add(
+                        self.show_capture_progress, min(progress, 1.0),
+                        f"Long exposure: {exposure.frames} frames",
+                    )
+        except Exception as e:
+            print(f"Long exposure error: {e}")
+            GLib.idle_add(self.show_toast, f"Long exposure failed: {e}")
+            exposure = None
+        finally:
+            self.long_exposure_active = False
+            # Give back any requests the camera thread queued meanwhile
+            while not self.long_exposure_requests.empty():
+                self.long_exposure_requests.get_nowait().release()
+            GLib.idle_add(self.hide_capture_progress)
+
+        if exposure is None or not exposure.frames:
+            self.still_writer.unreserve(nbytes)
+            return
+        print(
+            f"Long exposure: {exposure.frames} frames ({self.long_exposure_blend}), "
+            f"{blend_time * 1000.0 / exposure.frames:.1f} ms per frame, "
+            f"{self.long_exposure_dropped} dropped"
+        )
+        image = exposure.result()
+        del exposure
+        self.save_still(image, self.get_capture_filename() + "_long.jpg", nbytes)
+
+    def show_long_exposure(self, exposure):
+        """Put the partial blend in the viewfinder"""
+        index = self.frame_ring.acquire()
+        if index is None:
+            return
+        exposure.render(self.frame_ring.buffers[index])
+        if self.probes.enabled:
+            self.frame_times[index] = (time.monotonic(), time.monotonic())
+        if self.frame_mailbox.post(index):
+            GLib.idle_add(self.update_picture_widget)
+
+    def arm_motion(self):
+        if self.frame_ring is None:
+            # The camera never started, so there is no stream to watch
+            self.show_toast("Motion detection failed: no camera")
+            return
+        self.motion_detector = MotionDetector(
+            self.frame_ring.width,
+            self.frame_ring.height,
+            grid=self.motion_grid,
+            thresholds=self.motion_thresholds,
+            sensitivity=self.motion_sensitivity,
+        )
+        self.motion_trigger = MotionTrigger(self.motion_cooldown, self.motion_max_clip)
+        self.motion_armed = True
+        self.show_capture_progress(0.0, "Motion: watching")
+        self.show_toast("Motion detection armed")
+
+    def disarm_motion(self):
+        self.motion_armed = False
+        if self.motion_recording:
+            self.motion_recording = False
+            self.record_button.set_active(False)
+        print(
+            f"Motion: disarmed after {self.motion_detector.frames} frames, "
+            f"{self.motion_detector.mean_ms():.2f} ms detection per frame"
+        )
+        self.hide_capture_progress()
+        self.show_toast("Motion detection off")
+
+    def check_motion(self, yuv):
+        """Runs on the preview thread for each lores frame while armed"""
+        regions = self.motion_detector.update(yuv)
+        event = self.motion_trigger.update(bool(regions.any()), time.monotonic())
+        if event == "start":
+            print(
+                f"Motion: triggered in regions {np.argwhere(regions).tolist()}, "
+                f"{self.motion_detector.mean_ms():.2f} ms detection per frame"
+            )
+            self.on_motion_start()
+        elif event == "stop":
+            print("Motion: clip ended")
+            self.on_motion_stop()
+
+    def on_motion_start(self):
+        can_record = encoders_present and self.zsl_config is None
+        if self.motion_action == "record" and can_record:
+            if not self.recording:
+                self.motion_recording = True
+                GLib.idle_add(self.record_button.set_active, True)
+            GLib.idle_add(self.show_capture_progress, 1.0, "Motion: recording")
+        elif not self.burst_running:
+            self.burst_running = True
+            self.burst_stop.clear()
+            self.executor.submit(self.capture_burst)
+            GLib.idle_add(self.show_capture_progress, 1.0, "Motion: burst")
+
+    def on_motion_stop(self):
+        if self.motion_recording:
+            self.motion_recording = False
+            GLib.idle_add(self.record_button.set_active, False)
+        GLib.idle_add(self.show_capture_progress, 0.0, "Motion: watching")
+
+    def resume_timelapses(self):
+        """Pick up sequences that were interrupted by the app closing"""
+        for session in TimelapseSession.find_unfinished("captures", self.storage):
+            if session.status == "assembling":
+                self.assemble_timelapse(session)
+            elif self.timelapse is None:
+                print(
+                    f"Timelapse: resuming {session.directory} at frame "
+                    f"{session.next_index} of {session.frames}"
+                )
+                GLib.idle_add(self.show_toast, "Resuming timelapse")
+                self.start_timelapse(session)
+
+    def start_timelapse(self, session):
+        self.timelapse = session
+        self.timelapse_stop.clear()
+        threading.Thread(target=self.run_timelapse, args=(session,), daemon=True).start()
+
+    def run_timelapse(self, session):
+        """Capture the sequence on a fixed grid of monotonic deadlines
+
+        Each deadline is computed from the start rather than from the last
+        capture, so late captures don't push the rest of the sequence back.
+        Slots missed by more than a whole interval are skipped, not caught up.
+        """
+        config = self.zsl_config or self.record_config
+        width, height = config["main"]["size"]
+        nbytes = width * height * 3
+        pending = []  # Frames still being written
+        last_exposure = None
+        start = time.monotonic()
+        slot = 0
+        try:
+            while session.remaining() and not self.timelapse_stop.is_set():
+                deadline = start + slot * session.interval
+                if self.timelapse_stop.wait(max(deadline - time.monotonic(), 0.0)):
+                    break
+                late = int((time.monotonic() - deadline) // session.interval)
+                if late > 0:
+                    session.missed += late
+                    slot += late
+                    continue
+                slot += 1
+
+                exposure, future = self.capture_timelapse_frame(session, nbytes)
+                if future is None:
+                    session.missed += 1
+                    continue
+                pending = [f for f in pending if not f.done()] + [future]
+                if last_exposure is not None:
+                    session.stats.add(exposure - last_exposure)
+                last_exposure = exposure
+                session.save()
+
+                GLib.idle_add(
+                    self.show_capture_progress,
+                    session.next_index / session.frames,
+                    f"Timelapse: {session.next_index} of {session.frames}",
+                )
+                if session.next_index % 10 == 0:
+                    print(f"Timelapse: {session.next_index} frames, {session.stats.format()}")
+        except Exception as e:
+            print(f"Timelapse error: {e}")
+            GLib.idle_add(self.show_toast, f"Timelapse stopped: {e}")
+        finally:
+            self.timelapse = None
+            GLib.idle_add(self.hide_capture_progress)
+
+        if not self.running:
+            # The app is closing; the sequence resumes on the next start
+            return
+        print(
+            f"Timelapse: {session.next_index} frames, {session.missed} missed, "
+            f"{session.stats.format()}"
+        )
+        for future in pending:
+            future.result()
+        if not session.next_index:
+            session.set_status("done")
+            return
+        session.set_status("assembling")
+        self.assemble_timelapse(session)
+
+    def capture_timelapse_frame(self, session, nbytes):
+        """Queue the next frame of the stream for saving
+
+        Returns the frame's sensor timestamp in seconds and the still writer
+        future, or (None, None) if the writer has no room for it.
+        """
+        if not self.still_writer.reserve(nbytes):
+            print("Timelapse: still writer full, skipping a frame")
+            return None, None
+        try:
+            request = self.picam2.capture_request()
+            try:
+                exposure = request.get_metadata()["SensorTimestamp"] / 1e9
+                with mapped_array(request, "main") as frame:
+                    # Always a copy: the view is only valid until the request goes back
+                    image = np.array(frame[..., :3])
+            finally:
+                request.release()
+        except Exception:
+            self.still_writer.unreserve(nbytes)
+            raise
+
+        path = session.frame_path(session.next_index)
+        session.next_index += 1
+        future = self.still_writer.submit(
+            image, path, nbytes, process=self.process_still, on_done=self.on_timelapse_frame_saved
+        )
+        return exposure, future
+
+    def on_timelapse_frame_saved(self, path, error):
+        if error:
+            GLib.idle_add(self.show_toast, f"Error saving timelapse frame: {error}")
+
+    def assemble_timelapse(self, session):
+        """Build the session's video in the background"""
+
+        def assemble():
+            process = assemble_video(session)
+            if process is None:
+                GLib.idle_add(self.show_toast, "Timelapse saved as frames, ffmpeg not found")
+            elif finish_assembly(session, process):
+                print(f"Timelapse: saved {session.video_path()}")
+                GLib.idle_add(self.show_toast, "Timelapse video saved")
+            else:
+                GLib.idle_add(self.show_toast, "Timelapse video assembly failed")
+
+        threading.Thread(target=assemble, daemon=True).start()
+
+    def wait_for_exposure(self, wanted, exposures, max_frames=15):
+        """Return the first request whose exposure is closest to `wanted`
+
+        New exposure times take a few frames to reach the sensor; frames in
+        between are released. The caller must release the returned request.
+        """
+        for _ in range(max_frames):
+            request = self.picam2.capture_request()
+            exposure = request.get_metadata()["ExposureTime"]
+            if min(exposures, key=lambda e: abs(e - exposure)) == wanted:
+                return request
+            request.release()
+        print(f"HDR: exposure {wanted} us not reached, using the next frame")
+        return self.picam2.capture_request()
+
+    def on_hdr_progress(self, merged, total):
+        """Runs on an HDR merger thread as each frame is folded in"""
+        if merged < total:
+            text = f"HDR: merged {merged} of {total}"
+        else:
+            text = "HDR: tone mapping"
+        GLib.idle_add(self.show_capture_progress, merged / (total + 1), text)
+
+    def show_capture_progress(self, fraction, text):
+        self.capture_progress.set_fraction(fraction)
+        self.capture_progress.set_text(text)
+        self.capture_progress.set_visible(True)
+        return False
+
+    def hide_capture_progress(self):
+        self.capture_progress.set_visible(False)
+        return False
+
+    def save_still(self, image, path, nbytes):
+        """Queue a copied-out frame (with `nbytes` reserved) to be written"""
+        self.still_writer.submit(
+            image, path, nbytes, process=self.process_still, on_done=self.on_still_saved
         )
 
-        image.save("main", self.get_capture_filename() + ".jpg")
+    def process_still(self, image):
+        """Runs on a still writer thread before the JPEG is encoded"""
+        if self.processing_mode == "software":
+            # Same adjustments as the preview, from a snapshot of the sliders
+            engine = AdjustmentEngine()
+            engine.set_params(
+                self.brightness_value,
+                self.contrast_value,
+                self.saturation_value,
+                self.sharpness_value,
+            )
+            try:
+                self.still_processor.process(image, engine, self.still_sigma(image.shape[1]))
+                print(
+                    f"Still processed in {self.still_processor.last_tiles} tiles, "
+                    f"{self.still_processor.last_in_flight} at a time, "
+                    f"{self.still_processor.last_time * 1000.0:.0f} ms, "
+                    f"{self.still_processor.last_peak_bytes / 1e6:.1f} MB scratch"
+                )
+            except Exception as e:
+                print(f"Error in image processing: {e}")
+        return image
+
+    def still_sigma(self, width):
+        """Unsharp mask radius that gives a still the look of the preview"""
+        # The preview is sharpened at lores size, so scale the blur with it
+        return SHARPEN_SIGMA * width / self.frame_ring.width
 
     def get_capture_filename(self):
         timestamp = time.strftime("%Y%m%d_%H%M%S")
+        # The sequence keeps shots taken within the same second apart
+        sequence = next(self.capture_sequence)
         os.makedirs("captures", exist_ok=True)
-        return f"captures/capture_{timestamp}"
+        return f"captures/capture_{timestamp}_{sequence:04d}"
 
     def show_toast(self, message):
         toast = Adw.Toast.new(message)
@@ -739,14 +1957,29 @@ class CameraApp(Adw.Application):
         # Stop video playback
         self.stop_video_playback()
             
-        if self.picam2 and self.recording:
+        if self.preroll_output:
+            self.preroll_output.stop_recording()
+        if self.picam2 and (self.recording or self.preroll_output):
             try:
                 self.picam2.stop_encoder()
             except:
                 pass
 
         self.running = False
+        self.timelapse_stop.set()
         self.executor.shutdown(wait=True)
+        self.still_writer.shutdown()
+        if self.still_processor:
+            self.still_processor.shutdown()
+        if self.burst_writer:
+            self.burst_writer.shutdown()
+        if self.hdr_merger:
+            self.hdr_merger.shutdown()
+        self.storage.flush()
+        if self.zsl_ring:
+            self.zsl_ring.clear()
+        if self.strip_processor:
+            self.strip_processor.shutdown()
         if self.picam2:
             try:
                 self.picam2.stop()
@@ -0,0 +1,316 @@
+import io
+import multiprocessing
+import queue
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from processing import LUMA_WEIGHTS
+
+# sRGB-encoded 0-255 values to linear light, 0-1
+SRGB_TO_LINEAR = np.where(
+    np.arange(256) <= 10,
+    np.arange(256) / 255.0 / 12.92,
+    ((np.arange(256) / 255.0 + 0.055) / 1.055) ** 2.4,
+).astype(np.float32)
+
+# Debevec's hat weighting: trust mid-tones, not values near black or clipping
+HAT_WEIGHTS = (np.minimum(np.arange(256), 255 - np.arange(256)) / 127.5).astype(np.float32)
+
+# Keeps pixels that are clipped or black in every frame from dividing by zero
+MIN_WEIGHT = 1e-3
+
+
+class HdrAccumulator:
+    """Merges bracketed exposures into a radiance map one frame at a time.
+
+    Each frame is linearised, divided by its exposure time and added to a
+    float32 running sum weighted by how well exposed the pixel is, so only
+    the sum, the weights and the frame being added are ever in memory,
+    however many brackets there are. The weight of a pixel is that of its
+    worst exposed channel, which keeps colours from shifting where one
+    channel clips. Work is done in bands of rows to keep temporaries small.
+    """
+
+    def __init__(self, shape, band_rows=64):
+        height, width = shape[:2]
+        self.shape = shape
+        self.band_rows = band_rows
+        self.radiance = np.zeros((height, width, 3), dtype=np.float32)
+        self.weights = np.zeros((height, width), dtype=np.float32)
+        self.frames = 0
+
+    def bands(self):
+        height = self.shape[0]
+        return [(top, min(top + self.band_rows, height)) for top in range(0, height, self.band_rows)]
+
+    def add(self, image, exposure):
+        """Accumulate an RGB uint8 frame taken with `exposure` seconds"""
+        radiance_table = SRGB_TO_LINEAR / exposure
+        for top, bottom in self.bands():
+            band = image[top:bottom]
+            hat = cv2.LUT(band, HAT_WEIGHTS)
+            weight = cv2.min(cv2.min(hat[..., 0], hat[..., 1]), hat[..., 2])
+            weight += MIN_WEIGHT
+            radiance = cv2.LUT(band, radiance_table)
+            np.multiply(radiance, weight[..., None], out=radiance)
+
+            radiance_sum = self.radiance[top:bottom]
+            np.add(radiance_sum, radiance, out=radiance_sum)
+            weight_sum = self.weights[top:bottom]
+            np.add(weight_sum, weight, out=weight_sum)
+        self.frames += 1
+
+    def tonemap(self, key=0.18, gamma=2.2):
+        """Global Reinhard tone mapping of the merged radiance to RGB uint8"""
+        # First pass: log-average and peak luminance of the scene
+        log_sum = 0.0
+        peak = 0.0
+        for top, bottom in self.bands():
+            luminance = self.band_radiance(top, bottom) @ LUMA_WEIGHTS
+            log_sum += float(np.log(luminance + 1e-6).sum())
+            peak = max(peak, float(luminance.max()))
+        average = float(np.exp(log_sum / (self.shape[0] * self.shape[1])))
+        scale = key / average
+        white = max(peak * scale, 1e-6)
+
+        out = np.empty((self.shape[0], self.shape[1], 3), dtype=np.uint8)
+        for top, bottom in self.bands():
+            radiance = self.band_radiance(top, bottom)
+            luminance = radiance @ LUMA_WEIGHTS
+            scaled = luminance * scale
+            mapped = scaled * (1.0 + scaled / (white * white)) / (1.0 + scaled)
+            radiance *= (mapped / np.maximum(luminance, 1e-9))[..., None]
+            np.clip(radiance, 0.0, 1.0, out=radiance)
+            out[top:bottom] = np.rint(255.0 * radiance ** (1.0 / gamma))
+        return out
+
+    def band_radiance(self, top, bottom):
+        return self.radiance[top:bottom] / self.weights[top:bottom, :, None]
+
+
+# State of the HDR worker process; frames for one merge arrive in order
+_accumulator = None
+
+
+def hdr_begin(shape):
+    global _accumulator
+    _accumulator = HdrAccumulator(shape)
+
+
+def hdr_add(shm_name, shape, exposure):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        image = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+        _accumulator.add(image, exposure)
+        del image  # Drop the view before closing the mapping
+    finally:
+        shm.close()
+    return _accumulator.frames
+
+
+def hdr_finish(quality):
+    """Tone map the merge and return it as JPEG bytes"""
+    global _accumulator
+    try:
+        image = _accumulator.tonemap()
+        buffer = io.BytesIO()
+        Image.fromarray(image).save(buffer, format="JPEG", quality=quality)
+    finally:
+        _accumulator = None  # Hand the memory back between merges
+    return buffer.getvalue()
+
+
+class HdrMerger:
+    """Streams bracketed frames to a background process that merges them.
+
+    Frames are copied into one of two shared memory slots and merged while
+    the next exposure is being captured; add() waits when both are still
+    busy. on_progress(merged, total) is called from a pool thread as each
+    frame is folded in. The result is written through `storage`, a
+    StorageWriter.
+    """
+
+    def __init__(self, storage, shape, quality=90, on_progress=None):
+        self.storage = storage
+        self.shape = shape
+        self.quality = quality
+        self.on_progress = on_progress
+        nbytes = int(np.prod(shape))
+        self.slots = [shared_memory.SharedMemory(create=True, size=nbytes) for _ in range(2)]
+        self.free = queue.Queue()
+        for slot in self.slots:
+            self.free.put(slot)
+        self.total = 0
+
+        # A single worker runs the begin/add/finish calls in order. The app
+        # is multi-threaded (GTK, camera), so don't fork it
+        self.pool = ProcessPoolExecutor(
+            max_workers=1, mp_context=multiprocessing.get_context("spawn")
+        )
+
+    def begin(self, total):
+        """Start a merge of `total` frames"""
+        self.total = total
+        self.pool.submit(hdr_begin, self.shape).result()
+
+    def add(self, image, exposure):
+        """Queue an RGB frame taken with `exposure` seconds for merging"""
+        slot = self.free.get()
+        np.copyto(np.ndarray(self.shape, dtype=np.uint8, buffer=slot.buf), image)
+        future = self.pool.submit(hdr_add, slot.name, self.shape, exposure)
+        future.add_done_callback(lambda f: self.frame_merged(f, slot))
+        return future
+
+    def frame_merged(self, future, slot):
+        self.free.put(slot)
+        if self.on_progress and future.exception() is None:
+            self.on_progress(future.result(), self.total)
+
+    def finish(self, path):
+        """Tone map the merged frames and write them to `path` (a future)"""
+        return self.storage.write_result(self.pool.submit(hdr_finish, self.quality), path)
+
+    def shutdown(self):
+        self.pool.shutdown(wait=True)
+        for slot in self.slots:
+            slot.close()
+            slot.unlink()
+
+
+def overlap(shift, size):
+    """Source and destination slices that shift an axis of `size` by -`shift`"""
+    if shift >= 0:
+        return slice(shift, size), slice(0, size - shift)
+    return slice(0, size + shift), slice(-shift, size)
+
+
+class FrameStacker:
+    """Averages a sequence of frames, aligned to the first, for noise reduction.
+
+    Global motion is estimated by phase correlation between small luma
+    versions of each frame and of the first one, then applied as a whole
+    pixel shift while adding into a uint16 running sum, so stacking needs no
+    resampled copy of the frame. A per-pixel count keeps the borders that
+    some frames don't cover correctly exposed. At most 255 frames.
+    """
+
+    MAX_FRAMES = 255
+
+    def __init__(self, shape, align_width=1024, min_response=0.05):
+        height, width = shape[:2]
+        self.shape = shape
+        self.align_size = (align_width, max(round(height * align_width / width), 1))
+        self.align_scale = width / align_width
+        self.min_response = min_response
+
+        self.sum = np.zeros((height, width, 3), dtype=np.uint16)
+        self.counts = np.zeros((height, width), dtype=np.uint8)
+        self.reference = None
+        self.window = cv2.createHanningWindow(self.align_size, cv2.CV_32F)
+        self.frames = 0
+        self.rejected = 0
+
+    def align_luma(self, image):
+        gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+        small = cv2.resize(gray, self.align_size, interpolation=cv2.INTER_AREA)
+        return small.astype(np.float32)
+
+    def add(self, image):
+        """Align and add an RGB uint8 frame; returns its (dx, dy) or None if rejected"""
+        if self.frames >= self.MAX_FRAMES:
+            raise ValueError(f"Can't stack more than {self.MAX_FRAMES} frames")
+
+        luma = self.align_luma(image)
+        if self.reference is None:
+            self.reference = luma
+            dx = dy = 0
+        else:
+            (shift_x, shift_y), response = cv2.phaseCorrelate(self.reference, luma, self.window)
+            if response < self.min_response:
+                # Too little in common with the first frame, e.g. a big move
+                self.rejected += 1
+                return None
+            dx = int(round(shift_x * self.align_scale))
+            dy = int(round(shift_y * self.align_scale))
+
+        # This frame's pixel (x, y) lines up with (x - dx, y - dy) in the first
+        height, width = self.shape[:2]
+        if abs(dx) >= width or abs(dy) >= height:
+            self.rejected += 1
+            return None
+        src_y, dst_y = overlap(dy, height)
+        src_x, dst_x = overlap(dx, width)
+
+        total = self.sum[dst_y, dst_x]
+        np.add(total, image[src_y, src_x], out=total)
+        counts = self.counts[dst_y, dst_x]
+        np.add(counts, 1, out=counts)
+        self.frames += 1
+        return dx, dy
+
+    def result(self, band_rows=64):
+        """The stacked frame as RGB uint8"""
+        height = self.shape[0]
+        out = np.empty((height, self.shape[1], 3), dtype=np.uint8)
+        for top in range(0, height, band_rows):
+            bottom = min(top + band_rows, height)
+            counts = np.maximum(self.counts[top:bottom], 1)[..., None].astype(np.float32)
+            out[top:bottom] = np.rint(self.sum[top:bottom] / counts)
+        return out
+
+
+class LongExposure:
+    """Blends every frame of a stream into one long exposure.
+
+    "mean" averages the frames, smoothing anything that moves; "lighten"
+    keeps the brightest value each pixel reached, which draws light trails.
+    Both update a preallocated buffer in place with one OpenCV call per
+    frame. Frames keep their stream layout (RGB, or RGB plus a padding
+    byte for XBGR8888); the padding is dropped from the result.
+    """
+
+    BLENDS = ("mean", "lighten")
+
+    def __init__(self, shape, blend="mean"):
+        if blend not in self.BLENDS:
+            raise ValueError(f"Unknown blend {blend!r}")
+        self.shape = shape
+        self.blend = blend
+        if blend == "mean":
+            # float32 holds sums of up to 65793 frames exactly
+            self.buffer = np.zeros(shape, dtype=np.float32)
+        else:
+            self.buffer = np.zeros(shape, dtype=np.uint8)
+        self.frames = 0
+
+    def add(self, image):
+        if self.blend == "mean":
+            cv2.accumulate(image, self.buffer)
+        else:
+            cv2.max(self.buffer, image, dst=self.buffer)
+        self.frames += 1
+
+    def render(self, out):
+        """Write the blend so far, resized to fit the RGB uint8 frame `out`"""
+        height, width = out.shape[:2]
+        if (height, width) == self.shape[:2]:
+            blended = self.buffer
+        else:
+            blended = cv2.resize(self.buffer, (width, height), interpolation=cv2.INTER_AREA)
+        scale = 1.0 / max(self.frames, 1) if self.blend == "mean" else 1.0
+        np.multiply(blended[..., :3], scale, out=out, casting="unsafe")
+        return out
+
+    def result(self, band_rows=64):
+        """The finished exposure as RGB uint8"""
+        height = self.shape[0]
+        out = np.empty((height, self.shape[1], 3), dtype=np.uint8)
+        scale = 1.0 / max(self.frames, 1) if self.blend == "mean" else 1.0
+        for top in range(0, height, band_rows):
+            bottom = min(top + band_rows, height)
+            np.multiply(self.buffer[top:bottom, :, :3], scale, out=out[top:bottom], casting="unsafe")
+        return out
@@ -0,0 +1,107 @@
+import time
+
+import cv2
+import numpy as np
+
+
+class MotionDetector:
+    """Cheap motion detection on the luma plane of lores I420 frames.
+
+    The Y plane is decimated by `scale`, lightly blurred to tame sensor
+    noise and compared against a running-average background; pixels
+    that differ by more than `sensitivity` count as changed. The frame is
+    split into a grid of regions, and a region triggers when the fraction
+    of changed pixels in it exceeds its own threshold (0 disables a
+    region, e.g. a road or a tree in the wind).
+    Every image buffer is preallocated, so update() allocates no frames.
+    """
+
+    def __init__(self, width, height, grid=(4, 3), thresholds=None, scale=4,
+                 sensitivity=25, learning_rate=0.05):
+        columns, rows = grid
+        # Round the small frame down to a whole number of pixels per region
+        small_width = (width // scale) // columns * columns
+        small_height = (height // scale) // rows * rows
+        self.scale = scale
+        self.size = (small_width, small_height)
+        self.grid = grid
+        self.sensitivity = sensitivity
+        self.learning_rate = learning_rate
+        if thresholds is None:
+            thresholds = [0.02] * (columns * rows)
+        if len(thresholds) != columns * rows:
+            raise ValueError(f"Need {columns * rows} region thresholds, got {len(thresholds)}")
+        # Compared against region averages of a 0/255 mask
+        self.thresholds = np.array(thresholds, dtype=np.float32).reshape(rows, columns) * 255.0
+
+        self.decimated = np.empty((small_height, small_width), dtype=np.uint8)
+        self.small = np.empty_like(self.decimated)
+        self.background = None  # float32 running average, set by the first frame
+        self.background_u8 = np.empty_like(self.small)
+        self.diff = np.empty_like(self.small)
+        self.mask = np.empty_like(self.small)
+        self.coverage = np.empty((rows, columns), dtype=np.uint8)
+
+        # Statistics
+        self.frames = 0
+        self.total_time = 0.0
+
+    def update(self, yuv):
+        """Feed an I420 frame; returns a bool grid of the regions that saw motion"""
+        started = time.perf_counter()
+        # A strided view of the Y plane; cheaper than an area resize, and the
+        # blur makes up for most of the noise that averaging would remove
+        width, height = self.size
+        np.copyto(self.decimated, yuv[:height * self.scale:self.scale, :width * self.scale:self.scale])
+        cv2.blur(self.decimated, (3, 3), dst=self.small)
+
+        if self.background is None:
+            self.background = self.small.astype(np.float32)
+        cv2.convertScaleAbs(self.background, dst=self.background_u8)
+        cv2.absdiff(self.small, self.background_u8, dst=self.diff)
+        cv2.threshold(self.diff, self.sensitivity, 255, cv2.THRESH_BINARY, dst=self.mask)
+        # Averaging the mask down to the grid gives each region's changed
+        # fraction, in 1/255 steps
+        cv2.resize(self.mask, self.grid, dst=self.coverage, interpolation=cv2.INTER_AREA)
+        cv2.accumulateWeighted(self.small, self.background, self.learning_rate)
+
+        triggered = (self.coverage > self.thresholds) & (self.thresholds > 0)
+        self.frames += 1
+        self.total_time += time.perf_counter() - started
+        return triggered
+
+    def mean_ms(self):
+        return self.total_time * 1000.0 / self.frames if self.frames else 0.0
+
+
+class MotionTrigger:
+    """Turns per-frame motion into clip start and stop events.
+
+    A clip starts on motion, keeps going while motion is seen at least every
+    `hold` seconds and never runs longer than `max_clip`. After a clip ends
+    no new one starts for `cooldown` seconds.
+    """
+
+    def __init__(self, cooldown=10.0, max_clip=60.0, hold=5.0):
+        self.cooldown = cooldown
+        self.max_clip = max_clip
+        self.hold = hold
+        self.clip_start = None  # Set while a clip is running
+        self.last_motion = 0.0
+        self.quiet_until = 0.0
+
+    def update(self, motion, now):
+        """Returns "start", "stop" or None"""
+        if self.clip_start is None:
+            if motion and now >= self.quiet_until:
+                self.clip_start = self.last_motion = now
+                return "start"
+            return None
+
+        if motion:
+            self.last_motion = now
+        if now - self.clip_start >= self.max_clip or now - self.last_motion >= self.hold:
+            self.clip_start = None
+            self.quiet_until = now + self.cooldown
+            return "stop"
+        return None
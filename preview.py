@@ -0,0 +1,367 @@
+import json
+import math
+import os
+import threading
+import time
+
+import numpy as np
+
+
+class FrameRing:
+    """A small ring of preallocated RGB frame buffers for the viewfinder.
+
+    The preview thread acquires a free buffer, converts and processes the
+    frame straight into it, and hands its index to the display side. The
+    buffer comes back to the ring once GTK has released it.
+    """
+
+    def __init__(self, width, height, count=4, channels=3):
+        self.width = width
+        self.height = height
+        self.stride = width * channels
+        self.buffers = [
+            np.empty((height, width, channels), dtype=np.uint8) for _ in range(count)
+        ]
+        self.free = list(range(count))
+        self.lock = threading.Lock()
+
+        # Statistics
+        self.frames_displayed = 0
+        self.bytes_copied = 0
+        self.starved = 0  # Frames dropped because every buffer was in use
+
+    def acquire(self):
+        """Take a free buffer index, or None if all of them are still in use"""
+        with self.lock:
+            if not self.free:
+                self.starved += 1
+                return None
+            return self.free.pop()
+
+    def release(self, index):
+        """Give a buffer back to the ring"""
+        with self.lock:
+            self.free.append(index)
+
+    def record_display(self, copied_bytes):
+        """Count a displayed frame and the bytes copied to get it on screen"""
+        with self.lock:
+            self.frames_displayed += 1
+            self.bytes_copied += copied_bytes
+
+    def bytes_copied_per_frame(self):
+        with self.lock:
+            if not self.frames_displayed:
+                return 0.0
+            return self.bytes_copied / self.frames_displayed
+
+
+class FrameMailbox:
+    """Single-slot, latest-frame-wins handoff from the preview thread to GTK.
+
+    post() overwrites any frame that has not been shown yet and tells the
+    caller whether an idle callback still needs scheduling, so at most one
+    callback and one pending frame exist at any time.
+    """
+
+    def __init__(self, on_drop=None):
+        self.on_drop = on_drop  # Called with frames that were overwritten
+        self.pending = None
+        self.scheduled = False
+        self.lock = threading.Lock()
+
+        # Statistics
+        self.posted = 0
+        self.dropped = 0
+
+    def post(self, frame):
+        """Offer a frame; returns True if the caller must schedule a callback"""
+        with self.lock:
+            stale = self.pending
+            self.pending = frame
+            self.posted += 1
+            schedule = not self.scheduled
+            self.scheduled = True
+            if stale is not None:
+                self.dropped += 1
+
+        if stale is not None and self.on_drop:
+            self.on_drop(stale)
+        return schedule
+
+    def take(self):
+        """Collect the latest frame (or None) from the scheduled callback"""
+        with self.lock:
+            frame = self.pending
+            self.pending = None
+            self.scheduled = False
+            return frame
+
+
+class PreviewScheduler:
+    """Deadline-based pacing for preview frames, driven by frame arrival.
+
+    Every completed camera request is offered with its sensor timestamp. A
+    frame is accepted when its deadline has come and the previous frame has
+    finished processing; frames that arrive while the worker is busy or
+    before the deadline are skipped rather than queued.
+    """
+
+    def __init__(self, fps=30.0, window=120):
+        self.set_fps(fps)
+        self.next_deadline = None
+        self.last_accepted = None
+        self.busy = False
+        self.lock = threading.Lock()
+
+        # Statistics
+        self.intervals = np.zeros(window, dtype=np.float64)
+        self.interval_count = 0
+        self.accepted = 0
+        self.skipped_busy = 0
+        self.skipped_early = 0
+
+    def set_fps(self, fps):
+        self.fps = fps
+        self.period = 1.0 / fps
+        # Frames may arrive this much before their deadline and still count,
+        # which absorbs sensor jitter when the camera runs at the target rate
+        self.tolerance = self.period * 0.25
+
+    def offer(self, timestamp):
+        """Decide whether the frame captured at `timestamp` (s) gets processed"""
+        with self.lock:
+            if self.busy:
+                self.skipped_busy += 1
+                return False
+            if self.next_deadline is not None and timestamp < self.next_deadline - self.tolerance:
+                self.skipped_early += 1
+                return False
+
+            if self.next_deadline is None or timestamp >= self.next_deadline + self.period:
+                # First frame, or we fell more than a frame behind: resync
+                # instead of bursting to catch up
+                self.next_deadline = timestamp + self.period
+            else:
+                self.next_deadline += self.period
+
+            if self.last_accepted is not None:
+                self.intervals[self.interval_count % len(self.intervals)] = (
+                    timestamp - self.last_accepted
+                )
+                self.interval_count += 1
+            self.last_accepted = timestamp
+            self.accepted += 1
+            self.busy = True
+            return True
+
+    def finish(self):
+        """Mark the accepted frame as processed"""
+        with self.lock:
+            self.busy = False
+
+    def stats(self):
+        """Return (achieved fps, jitter in ms) over the recent window"""
+        with self.lock:
+            count = min(self.interval_count, len(self.intervals))
+            if not count:
+                return 0.0, 0.0
+            recent = self.intervals[:count]
+            mean = float(recent.mean())
+            return (1.0 / mean if mean > 0 else 0.0), float(recent.std()) * 1000.0
+
+
+class CpuTimeCounter:
+    """Accumulates the CPU time spent processing each preview frame"""
+
+    def __init__(self):
+        self.frames = 0
+        self.total = 0.0
+        self.last = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, seconds):
+        with self.lock:
+            self.frames += 1
+            self.total += seconds
+            self.last = seconds
+
+    def mean_ms(self):
+        with self.lock:
+            if not self.frames:
+                return 0.0
+            return self.total * 1000.0 / self.frames
+
+
+class QualityGovernor:
+    """Steps preview quality down when frames overrun their budget.
+
+    Tiers, from best to cheapest:
+      0 full quality
+      1 sharpening off
+      2 processing at half resolution, then upscaled
+      3 half resolution and a lower preview frame rate
+
+    A smoothed per-frame processing time above `high` x budget for
+    `down_frames` frames drops one tier; below `low` x budget for
+    `up_frames` frames restores one. The gap between the thresholds and the
+    longer wait for stepping up keep it from oscillating; a step up that has
+    to be undone straight away doubles the wait before the next one.
+    """
+
+    FULL = 0
+    NO_SHARPEN = 1
+    HALF_RES = 2
+    LOW_FPS = 3
+    NAMES = ("full quality", "sharpening off", "half resolution", "reduced frame rate")
+
+    def __init__(self, budget, high=0.9, low=0.5, down_frames=10, up_frames=90, smoothing=0.1):
+        self.budget = budget
+        self.high = high
+        self.low = low
+        self.down_frames = down_frames
+        self.up_frames = up_frames
+        self.smoothing = smoothing
+
+        self.tier = self.FULL
+        self.average = 0.0
+        self.over = 0
+        self.under = 0
+        self.up_wait = up_frames
+        self.since_up = None  # Frames since the last step up
+
+    def update(self, seconds):
+        """Feed one frame's processing time; returns the new tier on a change"""
+        self.average += self.smoothing * (seconds - self.average)
+        if self.since_up is not None:
+            self.since_up += 1
+
+        if self.average > self.high * self.budget:
+            self.over += 1
+            self.under = 0
+        elif self.average < self.low * self.budget:
+            self.under += 1
+            self.over = 0
+        else:
+            self.over = self.under = 0
+
+        if self.over >= self.down_frames and self.tier < self.LOW_FPS:
+            if self.since_up is not None and self.since_up < self.up_wait:
+                # The last step up didn't hold, be more patient next time
+                self.up_wait = min(self.up_wait * 2, self.up_frames * 16)
+            self.since_up = None
+            return self.change(self.tier + 1)
+        if self.under >= self.up_wait and self.tier > self.FULL:
+            self.since_up = 0
+            return self.change(self.tier - 1)
+        if self.since_up is not None and self.since_up >= self.up_wait * 4:
+            # Stable for a good while, go back to reacting normally
+            self.up_wait = self.up_frames
+            self.since_up = None
+        return None
+
+    def change(self, tier):
+        self.tier = tier
+        self.over = self.under = 0
+        return tier
+
+    def name(self):
+        return self.NAMES[self.tier]
+
+
+class LatencyHistogram:
+    """Fixed-size, log-spaced latency histogram backed by a numpy array.
+
+    Bins grow by `ratio` from `minimum` seconds, so recording is a log and
+    an array increment with no allocation; percentiles are read from the
+    cumulative counts and are accurate to one bin width.
+    """
+
+    def __init__(self, minimum=1e-5, ratio=1.1, bins=128):
+        self.minimum = minimum
+        self.log_ratio = math.log(ratio)
+        self.counts = np.zeros(bins, dtype=np.int64)
+        self.edges = minimum * ratio ** np.arange(1, bins + 1)  # Upper bin edges
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def add(self, seconds):
+        if seconds <= self.minimum:
+            index = 0
+        else:
+            index = min(int(math.log(seconds / self.minimum) / self.log_ratio), len(self.counts) - 1)
+        self.counts[index] += 1
+        self.total += seconds
+        if seconds > self.maximum:
+            self.maximum = seconds
+
+    def count(self):
+        return int(self.counts.sum())
+
+    def percentile(self, fraction):
+        """Upper edge of the bin holding the given fraction of samples, in s"""
+        count = self.count()
+        if not count:
+            return 0.0
+        cumulative = np.cumsum(self.counts)
+        index = int(np.searchsorted(cumulative, fraction * count))
+        return float(min(self.edges[index], self.maximum))
+
+    def summary(self):
+        count = self.count()
+        return {
+            "count": count,
+            "mean_ms": self.total * 1000.0 / count if count else 0.0,
+            "p50_ms": self.percentile(0.5) * 1000.0,
+            "p90_ms": self.percentile(0.9) * 1000.0,
+            "p99_ms": self.percentile(0.99) * 1000.0,
+            "max_ms": self.maximum * 1000.0,
+        }
+
+
+class StageProbes:
+    """Named latency probes for the preview hot path.
+
+    When disabled, start() and stop() do no clock reads and record nothing,
+    so leaving the calls in place costs a couple of attribute lookups per
+    stage. Each stage is expected to be recorded from a single thread.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.histograms = {}
+
+    def start(self):
+        return time.perf_counter() if self.enabled else 0.0
+
+    def stop(self, stage, started):
+        if self.enabled:
+            self.record(stage, time.perf_counter() - started)
+
+    def record(self, stage, seconds):
+        if not self.enabled:
+            return
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            histogram = self.histograms[stage] = LatencyHistogram()
+        histogram.add(seconds)
+
+    def summary(self):
+        return {stage: h.summary() for stage, h in list(self.histograms.items())}
+
+    def format(self):
+        """One line per stage, for the on-screen overlay"""
+        lines = []
+        for stage, stats in self.summary().items():
+            lines.append(
+                f"{stage:<8} p50 {stats['p50_ms']:6.2f}  p99 {stats['p99_ms']:6.2f} ms"
+            )
+        return "\n".join(lines)
+
+    def dump(self, path):
+        """Write the current summary as JSON, replacing the file atomically"""
+        data = {"timestamp": time.time(), "stages": self.summary()}
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f, indent=2)
+        os.replace(tmp_path, path)
@@ -0,0 +1,302 @@
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+# Gaussian sigma of the unsharp mask at preview resolution
+SHARPEN_SIGMA = 2.0
+
+# Rows of context the unsharp mask needs on each side of a strip. OpenCV
+# sizes the sigma 2.0 uint8 kernel to 13 taps (a radius of 6 rows); the halo
+# is rounded up to 8 so strips still start on I420 chroma boundaries
+SHARPEN_HALO = 8
+
+# Rec. 601 luma weights; saturation scales chroma around this luma
+LUMA_WEIGHTS = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+
+
+class AdjustmentEngine:
+    """Brightness, contrast, saturation and sharpness for preview and stills.
+
+    Brightness, contrast and saturation are folded into one 3x4 affine colour
+    matrix, recomputed only when a slider changes and applied in a single
+    cv2.transform pass. With saturation neutral the matrix is diagonal, so a
+    256-entry lookup table does the same job even cheaper. Sharpening is an
+    optional unsharp mask. The transform is affine per pixel and the blur
+    linear, so the mask is worked out on the input and the transform
+    applied to the result, with the only clip at the end, as if the
+    transformed frame had been sharpened before clipping.
+    """
+
+    def __init__(self):
+        self.brightness = 0.0
+        self.contrast = 1.0
+        self.saturation = 1.0
+        self.sharpness = 1.0
+
+        self.matrix = None  # 3x4 affine transform on 0-255 RGB values
+        self.lut = None  # The same transform when it is diagonal
+        self.rebuild()
+
+    def set_params(self, brightness, contrast, saturation, sharpness):
+        """Update adjustment values, rebuilding the transform only when needed"""
+        if (brightness, contrast, saturation) != (self.brightness, self.contrast, self.saturation):
+            self.brightness = brightness
+            self.contrast = contrast
+            self.saturation = saturation
+            self.rebuild()
+        self.sharpness = sharpness
+
+    def rebuild(self):
+        """Precompute the colour matrix and lookup table"""
+        # Brightness (additive, scaled down) then contrast around mid grey:
+        #   y = (x / 255 + 0.3 * b - 0.5) * c + 0.5
+        gain = self.contrast
+        offset = 255.0 * ((self.brightness * 0.3 - 0.5) * self.contrast + 0.5)
+
+        # Saturation blends each channel with luma: s * I + (1 - s) * [w; w; w].
+        # Its rows sum to one, so it leaves the grey offset unchanged
+        saturation = self.saturation * np.eye(3, dtype=np.float32)
+        saturation += (1.0 - self.saturation) * np.tile(LUMA_WEIGHTS, (3, 1))
+
+        matrix = np.empty((3, 4), dtype=np.float32)
+        matrix[:, :3] = gain * saturation
+        matrix[:, 3] = offset
+
+        values = np.arange(256, dtype=np.float32) * gain + offset
+        self.lut = np.clip(np.rint(values), 0, 255).astype(np.uint8).reshape(256, 1)
+        self.matrix = matrix
+
+    def apply(self, image, out=None, sharpen=True, sigma=SHARPEN_SIGMA):
+        """Apply the adjustments to an RGB uint8 image
+
+        If out is given the result is written into it (it may be image itself)
+        and no new output frame is allocated. sharpen=False skips the unsharp
+        mask stage whatever the slider says; sigma sets its blur radius.
+        """
+        if sharpen and self.sharpness != 1.0:
+            return self.apply_sharpened(image, out, sigma)
+        if self.saturation == 1.0:
+            return cv2.LUT(image, self.lut, dst=out)
+        return cv2.transform(image, self.matrix, dst=out)
+
+    def apply_sharpened(self, image, out, sigma):
+        """Unsharp mask and colour transform with a single clip at the end"""
+        gaussian = cv2.GaussianBlur(image, (0, 0), sigma)
+        amount = self.sharpness
+        if self.saturation == 1.0:
+            # A diagonal transform folds into the weights; addWeighted
+            # saturates to uint8 only once the sum is formed
+            gain, offset = self.matrix[0, 0], self.matrix[0, 3]
+            return cv2.addWeighted(image, amount * gain, gaussian, (1.0 - amount) * gain, offset,
+                                   dst=out)
+
+        # Sharpened values overshoot 0-255, so keep them signed until the
+        # end. (addWeighted from uint8 straight to int16 is several times
+        # slower than these steps.)
+        detail = cv2.subtract(image, gaussian, dtype=cv2.CV_16S)
+        del gaussian
+        sharpened = cv2.scaleAdd(detail, amount - 1.0, image.astype(np.int16), dst=detail)
+        sharpened = cv2.transform(sharpened, self.matrix, dst=sharpened)
+        cv2.max(sharpened, 0, dst=sharpened)
+        # Negatives are gone, so this just saturates to uint8
+        return cv2.convertScaleAbs(sharpened, dst=out)
+
+    def scratch_copies(self, sharpen=True):
+        """Frame-sized uint8 buffers apply() allocates besides its output"""
+        if not sharpen or self.sharpness == 1.0:
+            return 0
+        # The blur, or for a full matrix two 16-bit frames
+        return 1 if self.saturation == 1.0 else 4
+
+
+def yuv420_to_rgb(yuv, out=None):
+    """Convert a planar I420 frame (as returned by capture_array) to RGB"""
+    return cv2.cvtColor(yuv, cv2.COLOR_YUV2RGB_I420, dst=out)
+
+
+class StripProcessor:
+    """Runs YUV conversion and adjustments on horizontal strips in parallel.
+
+    Each worker converts its own slice of the I420 frame (plus halo rows for
+    the blur when sharpening), adjusts it and writes its rows of the shared
+    output buffer. OpenCV and NumPy release the GIL, so plain threads scale
+    across cores.
+    """
+
+    def __init__(self, engine, workers=4):
+        self.engine = engine
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.last_cpu_time = 0.0  # CPU seconds the workers spent on the last frame
+
+    def process(self, yuv, out, sharpen=True):
+        """Convert and adjust `yuv` into the preallocated RGB frame `out`"""
+        height = out.shape[0]
+        sharpen = sharpen and self.engine.sharpness != 1.0
+
+        # I420 chroma rows pair up luma rows and two chroma rows share one
+        # stored row, so strip boundaries must fall on multiples of 4
+        step = -(-height // self.workers)
+        step = (step + 3) & ~3
+        bounds = [(top, min(top + step, height)) for top in range(0, height, step)]
+
+        futures = [
+            self.executor.submit(self.process_strip, yuv, out, top, bottom, sharpen)
+            for top, bottom in bounds
+        ]
+        self.last_cpu_time = sum(future.result() for future in futures)
+        return out
+
+    def process_strip(self, yuv, out, top, bottom, sharpen):
+        """Process one strip and return the CPU time it took"""
+        cpu_start = time.thread_time()
+        height = out.shape[0]
+        if not sharpen:
+            # Purely per-pixel work, write straight into the output rows
+            rows = out[top:bottom]
+            yuv420_to_rgb(self.slice_yuv(yuv, height, top, bottom), rows)
+            self.engine.apply(rows, out=rows, sharpen=False)
+        else:
+            start = max(top - SHARPEN_HALO, 0)
+            end = min(bottom + SHARPEN_HALO, height)
+            strip = yuv420_to_rgb(self.slice_yuv(yuv, height, start, end))
+            strip = self.engine.apply(strip, out=strip, sharpen=True)
+            out[top:bottom] = strip[top - start:bottom - start]
+        return time.thread_time() - cpu_start
+
+    @staticmethod
+    def slice_yuv(yuv, height, top, bottom):
+        """Build a standalone I420 buffer for luma rows [top, bottom)"""
+        quarter = height // 4
+        u = yuv[height:height + quarter]
+        v = yuv[height + quarter:height + 2 * quarter]
+        return np.concatenate(
+            (yuv[top:bottom], u[top // 4:bottom // 4], v[top // 4:bottom // 4])
+        )
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+def sharpen_halo(sigma):
+    """Rows of context the unsharp mask needs on each side at `sigma`"""
+    # OpenCV's uint8 Gaussian kernel reaches about 3 sigma from the centre
+    return math.ceil(3.0 * sigma) + 1
+
+
+class TileProcessor:
+    """Applies AdjustmentEngine settings to full resolution stills in bounded memory.
+
+    The frame is adjusted in place as a series of full-width tiles, several
+    at a time on a thread pool. Each tile is copied to a scratch buffer with
+    enough rows of overlap for the unsharp mask, processed there and its own
+    rows written back. The overlap rows are saved from the untouched frame
+    before any tile is written, so neighbouring tiles never see each other's
+    output and the result matches processing the whole frame at once.
+
+    The scratch buffers of the tiles in flight and the saved overlaps stay
+    within `budget` bytes on top of the frame itself. When a tall enough
+    tile doesn't fit with every worker busy, fewer tiles run at once, down
+    to one; if not even that fits, process() raises MemoryError rather
+    than go over the budget.
+    """
+
+    def __init__(self, budget=32 * 1024 * 1024, workers=None):
+        self.budget = budget
+        self.workers = workers or os.cpu_count() or 1
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="tile")
+        self.lock = threading.Lock()  # One frame at a time shares the budget
+
+        # Statistics for the last frame
+        self.last_tiles = 0
+        self.last_in_flight = 0
+        self.last_peak_bytes = 0
+        self.last_time = 0.0
+
+    def peak_bytes(self, height, width, rows, halo, copies, in_flight):
+        """Extra memory needed to process a frame in tiles of `rows` rows"""
+        row_bytes = width * 3
+        tiles = -(-height // rows)
+        # A scratch copy of each tile in flight, plus the `copies` the
+        # engine makes of it, and the saved overlaps of every tile
+        scratch = min(tiles, in_flight) * (rows + 2 * halo) * row_bytes * (1 + copies)
+        return scratch + tiles * 2 * halo * row_bytes
+
+    def tile_plan(self, height, width, halo, copies):
+        """Tile height and tiles in flight that keep the frame within the budget"""
+        # Tiles thinner than their overlaps spend more on context than on
+        # their own rows, so parallelism gives way before tiles get that thin
+        shortest = min(max(16, -(-2 * halo // 16) * 16), -(-height // 16) * 16)
+        for in_flight in range(self.workers, 0, -1):
+            fits = [
+                rows for rows in range(shortest, height + 16, 16)
+                if self.peak_bytes(height, width, rows, halo, copies, in_flight) <= self.budget
+            ]
+            if fits:
+                return fits[-1], in_flight
+        needed = min(
+            self.peak_bytes(height, width, rows, halo, copies, 1)
+            for rows in range(shortest, height + 16, 16)
+        )
+        raise MemoryError(
+            f"A {width}x{height} frame needs {needed / 1e6:.1f} MB of scratch, "
+            f"the budget is {self.budget / 1e6:.1f} MB"
+        )
+
+    def process(self, image, engine, sigma=SHARPEN_SIGMA):
+        """Adjust the RGB uint8 `image` in place with `engine` and return it"""
+        with self.lock:
+            started = time.perf_counter()
+            height, width = image.shape[:2]
+            copies = engine.scratch_copies()
+            halo = sharpen_halo(sigma) if copies else 0
+            step, in_flight = self.tile_plan(height, width, halo, copies)
+            bounds = [(top, min(top + step, height)) for top in range(0, height, step)]
+
+            # Overlap rows as they were before any tile is written back
+            saved = {}
+            if halo:
+                for top, bottom in bounds:
+                    saved[top] = (
+                        image[max(top - halo, 0):top].copy(),
+                        image[bottom:min(bottom + halo, height)].copy(),
+                    )
+
+            # Hand out a tile only once a scratch slot is free
+            slots = threading.Semaphore(in_flight)
+            futures = []
+            for top, bottom in bounds:
+                slots.acquire()
+                future = self.executor.submit(
+                    self.process_tile, image, engine, top, bottom, saved, sigma
+                )
+                future.add_done_callback(lambda _: slots.release())
+                futures.append(future)
+            for future in futures:
+                future.result()
+
+            self.last_tiles = len(bounds)
+            self.last_in_flight = min(len(bounds), in_flight)
+            self.last_peak_bytes = self.peak_bytes(height, width, step, halo, copies, in_flight)
+            self.last_time = time.perf_counter() - started
+            return image
+
+    def process_tile(self, image, engine, top, bottom, saved, sigma):
+        rows = image[top:bottom]
+        if not saved:
+            # Purely per-pixel work, adjust the rows where they are
+            engine.apply(rows, out=rows, sharpen=False)
+            return
+
+        above, below = saved[top]
+        tile = np.concatenate((above, rows, below))
+        engine.apply(tile, out=tile, sharpen=True, sigma=sigma)
+        rows[:] = tile[len(above):len(above) + len(rows)]
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
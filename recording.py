@@ -0,0 +1,658 @@
+import fcntl
+import os
+import shutil
+import subprocess
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from fractions import Fraction
+
+try:
+    import av
+    pyav_present = True
+except ImportError:
+    pyav_present = False
+
+# Encoder timestamps are in microseconds
+MICROSECONDS = Fraction(1, 1000000)
+
+# MP4 written front to back: a fragment per keyframe, no index to seek
+# back and fill in, and everything up to the last fragment plays after a
+# power cut
+STREAMING_MOVFLAGS = "frag_keyframe+empty_moov"
+
+
+def h264_bitrate(size, fps, reference=15000000):
+    """Bits per second Picamera2 encodes a stream at
+
+    It scales a bitrate for 1080p at 30 fps by pixel rate; the default
+    reference is that of Quality.VERY_HIGH.
+    """
+    width, height = size
+    return int(reference * width * height * fps / (1920 * 1080 * 30))
+
+
+# Picamera2's quality tiers and their H.264 bitrates for 1080p at 30 fps
+QUALITY_TIERS = (
+    ("very_high", 15000000),
+    ("high", 9000000),
+    ("medium", 6000000),
+    ("low", 4000000),
+    ("very_low", 2000000),
+)
+
+
+def set_encoder_bitrate(encoder, bitrate):
+    """Change a running Picamera2 V4L2 encoder's bitrate in place
+
+    The Pi's H.264 encoder takes a new bitrate between frames, so the
+    stream goes on without a restart. Returns False where that isn't
+    possible, e.g. an encoder that isn't running.
+    """
+    device = getattr(encoder, "vd", None)
+    if device is None:
+        return False
+    try:
+        from v4l2 import V4L2_CID_MPEG_VIDEO_BITRATE, VIDIOC_S_CTRL, v4l2_control
+
+        control = v4l2_control()
+        control.id = V4L2_CID_MPEG_VIDEO_BITRATE
+        control.value = bitrate
+        fcntl.ioctl(device, VIDIOC_S_CTRL, control)
+    except (ImportError, OSError, ValueError) as e:
+        print(f"Can't change the encoder bitrate: {e}")
+        return False
+    return True
+
+
+class RateController:
+    """Picks the recording bitrate and steps it down before the card falls behind.
+
+    The starting tier is the best one whose stream the card, at its
+    measured rate, writes with `headroom` to spare. While recording,
+    update() watches how much encoded video waits in the storage queue:
+    past half the queue's budget the bitrate drops a tier, at most once
+    per `settle` seconds, long before the queue fills and frames are lost.
+    After `recover` seconds with the queue nearly empty it climbs back a
+    tier, never above the starting one. Every change is kept for the
+    recording's log.
+    """
+
+    def __init__(self, size, fps, card_rate=None, headroom=2.0, settle=2.0, recover=10.0):
+        self.bitrates = [h264_bitrate(size, fps, reference) for _, reference in QUALITY_TIERS]
+        self.card_rate = card_rate  # Bytes per second, None if unknown
+        self.settle = settle
+        self.recover = recover
+        self.start_tier = len(QUALITY_TIERS) - 1
+        for tier, bitrate in enumerate(self.bitrates):
+            if card_rate is None or bitrate / 8 * headroom <= card_rate:
+                self.start_tier = tier
+                break
+        self.tier = self.start_tier
+        self.started = None
+        self.hold_until = 0.0
+        self.quiet_since = None
+        self.changes = []  # (seconds into the recording, bitrate, reason)
+
+    @property
+    def bitrate(self):
+        return self.bitrates[self.tier]
+
+    @property
+    def tier_name(self):
+        return QUALITY_TIERS[self.tier][0]
+
+    def start(self, now):
+        self.started = now
+        self.hold_until = now + self.settle
+        self.changes = [(0.0, self.bitrate, "start")]
+
+    def update(self, queued, budget, now):
+        """Returns the new bitrate when it should change, else None"""
+        if queued > budget / 2:
+            self.quiet_since = None
+            if now >= self.hold_until and self.tier < len(self.bitrates) - 1:
+                return self.change(self.tier + 1, now, f"{queued / 1e6:.1f} MB queued")
+        elif queued < budget / 10:
+            if self.quiet_since is None:
+                self.quiet_since = now
+            elif now - self.quiet_since >= self.recover and self.tier > self.start_tier:
+                self.quiet_since = now
+                return self.change(self.tier - 1, now, "queue drained")
+        else:
+            self.quiet_since = None
+        return None
+
+    def change(self, tier, now, reason):
+        self.tier = tier
+        self.hold_until = now + self.settle
+        self.changes.append((now - self.started, self.bitrate, reason))
+        return self.bitrate
+
+    def to_dict(self):
+        return {
+            "card_rate": self.card_rate,
+            "start_tier": QUALITY_TIERS[self.start_tier][0],
+            "bitrate": self.bitrate,
+            "changes": [
+                {"time": round(seconds, 3), "bitrate": bitrate, "reason": reason}
+                for seconds, bitrate, reason in self.changes
+            ],
+        }
+
+
+try:
+    from picamera2.outputs import Output
+except ImportError:
+    # Recording needs Picamera2 anyway; keep the module importable without it
+    class Output:
+        def __init__(self, pts=None):
+            self.recording = False
+
+        def start(self):
+            self.recording = True
+
+        def stop(self):
+            self.recording = False
+
+
+def copy_to_storage(pipe, file):
+    """Copy a pipe into a StorageFile until it closes"""
+    while True:
+        data = pipe.read1(1024 * 1024)
+        if not data:
+            return
+        file.write(data)
+
+
+class H264PipeOutput(Output):
+    """Muxes an H.264 elementary stream to MP4 through an ffmpeg pipe.
+
+    Unlike FfmpegOutput, frames are timed by their position in the stream
+    at `fps`, not by the wall clock when they reach ffmpeg, so frames that
+    were buffered and arrive in a rush still play back at the right pace.
+    ffmpeg writes a streaming MP4 to its stdout, which a thread copies
+    through `storage`; `finished` is a future of the file being complete.
+    """
+
+    def __init__(self, path, fps, storage):
+        super().__init__()
+        self.path = path
+        self.fps = fps
+        self.storage = storage
+        self.process = None
+        self.copier = None
+        self.file = None
+        self.finished = None
+
+    def start(self):
+        self.process = subprocess.Popen(
+            [
+                "ffmpeg", "-loglevel", "warning", "-y",
+                "-f", "h264", "-framerate", str(self.fps), "-i", "-",
+                "-c:v", "copy", "-f", "mp4", "-movflags", STREAMING_MOVFLAGS, "-",
+            ],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+        self.file = self.storage.open(self.path)
+        self.copier = threading.Thread(
+            target=copy_to_storage, args=(self.process.stdout, self.file), daemon=True
+        )
+        self.copier.start()
+        super().start()
+
+    def outputframe(self, frame, keyframe=True, timestamp=None, *args, **kwargs):
+        if self.recording:
+            self.process.stdin.write(frame)
+
+    def stop(self):
+        super().stop()
+        if self.process:
+            self.process.stdin.close()
+            self.process.wait()
+            self.copier.join()
+            self.finished = self.file.close()
+            self.process = None
+
+
+class PyAvOutput(Output):
+    """Muxes an H.264 elementary stream to MP4 inside this process with PyAV.
+
+    There is no helper process to launch at record start and no pipe to
+    copy every frame through. Packets are stamped with the encoder's
+    timestamps, relative to the first frame, so the file keeps the real
+    frame timing. The streaming MP4 is written through `storage`;
+    `finished` is a future of the file being complete.
+    """
+
+    def __init__(self, path, size, fps, storage):
+        super().__init__()
+        self.path = path
+        self.size = size
+        self.fps = fps
+        self.storage = storage
+        self.file = None
+        self.finished = None
+        self.container = None
+        self.stream = None
+        self.first_timestamp = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.file = self.storage.open(self.path)
+        self.container = av.open(
+            self.file, "w", format="mp4", options={"movflags": STREAMING_MOVFLAGS}
+        )
+        self.stream = self.container.add_stream("h264", rate=self.fps)
+        self.stream.width, self.stream.height = self.size
+        self.stream.time_base = MICROSECONDS
+        self.first_timestamp = None
+        super().start()
+
+    def outputframe(self, frame, keyframe=True, timestamp=None, *args, **kwargs):
+        with self.lock:
+            if not self.recording:
+                return
+            if timestamp is None:
+                timestamp = int(time.monotonic() * 1e6)
+            if self.first_timestamp is None:
+                self.first_timestamp = timestamp
+            packet = av.Packet(bytes(frame))
+            packet.stream = self.stream
+            packet.time_base = MICROSECONDS
+            packet.pts = packet.dts = timestamp - self.first_timestamp
+            packet.is_keyframe = keyframe
+            self.container.mux(packet)
+
+    def stop(self):
+        with self.lock:
+            super().stop()
+            if self.container:
+                self.container.close()
+                self.container = None
+                self.finished = self.file.close()
+
+
+class RawH264Output(Output):
+    """Writes the raw H.264 stream plus a timestamp sidecar, for remuxing later.
+
+    Recording is two plain appends per frame: the stream goes to
+    `<name>.h264` and the frame's time, in the mkvmerge "timestamp format
+    v2" (one millisecond value per line), to `<name>.pts`, both through
+    `storage`. remux_raw() turns the pair into `path` once the take is over.
+    """
+
+    def __init__(self, path, storage):
+        super().__init__()
+        self.path = path
+        self.storage = storage
+        self.finished = None
+        base = os.path.splitext(path)[0]
+        self.raw_path = base + ".h264"
+        self.pts_path = base + ".pts"
+        self.raw_file = None
+        self.pts_file = None
+        self.first_timestamp = None
+
+    def start(self):
+        self.raw_file = self.storage.open(self.raw_path)
+        self.pts_file = self.storage.open(self.pts_path)
+        self.pts_file.write(b"# timestamp format v2\n")
+        self.first_timestamp = None
+        super().start()
+
+    def outputframe(self, frame, keyframe=True, timestamp=None, *args, **kwargs):
+        if not self.recording:
+            return
+        if timestamp is None:
+            timestamp = int(time.monotonic() * 1e6)
+        if self.first_timestamp is None:
+            self.first_timestamp = timestamp
+        self.raw_file.write(frame)
+        self.pts_file.write(f"{(timestamp - self.first_timestamp) / 1000.0:.3f}\n".encode())
+
+    def stop(self):
+        super().stop()
+        if self.raw_file:
+            self.raw_file.close()
+            # Storage writes complete in order, so this covers both files
+            self.finished = self.pts_file.close()
+            self.raw_file = self.pts_file = None
+
+
+def read_timestamps(pts_path):
+    """Frame times in milliseconds from a "timestamp format v2" file"""
+    with open(pts_path) as f:
+        return [float(line) for line in f if line.strip() and not line.startswith("#")]
+
+
+def remux_raw(output, fps):
+    """Turn a RawH264Output's stream and sidecar into its MP4; returns success
+
+    With PyAV the packets are copied into the MP4 with their recorded
+    timestamps. Without it a low-priority ffmpeg remuxes the stream at a
+    constant `fps`. The MP4 goes through the output's storage under a
+    temporary name and is renamed into place; the raw files are removed
+    only once that succeeded.
+    """
+    partial = output.path + ".part"
+    file = None
+    try:
+        output.finished.result()
+        file = output.storage.open(partial)
+        if pyav_present:
+            timestamps = read_timestamps(output.pts_path)
+            target_options = {"movflags": STREAMING_MOVFLAGS}
+            with av.open(output.raw_path, format="h264") as source, \
+                    av.open(file, "w", format="mp4", options=target_options) as target:
+                source_stream = source.streams.video[0]
+                stream = target.add_stream("h264", rate=fps)
+                stream.width = source_stream.codec_context.width
+                stream.height = source_stream.codec_context.height
+                # The raw stream has no timing; frames pair up with the sidecar
+                frames = (packet for packet in source.demux(source_stream) if packet.size)
+                for packet, milliseconds in zip(frames, timestamps):
+                    packet.stream = stream
+                    packet.time_base = MICROSECONDS
+                    packet.pts = packet.dts = round(milliseconds * 1000)
+                    target.mux(packet)
+        elif shutil.which("ffmpeg"):
+            command = [
+                "nice", "-n", "19", "ffmpeg", "-y", "-loglevel", "error",
+                "-f", "h264", "-framerate", str(fps), "-i", output.raw_path,
+                "-c:v", "copy", "-f", "mp4", "-movflags", STREAMING_MOVFLAGS, "-",
+            ]
+            process = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE)
+            copy_to_storage(process.stdout, file)
+            if process.wait() != 0:
+                raise RuntimeError(f"ffmpeg exited with code {process.returncode}")
+        else:
+            print(f"Neither PyAV nor ffmpeg available, leaving {output.raw_path} as it is")
+            file.close()
+            os.remove(partial)
+            return False
+        file.close().result()
+    except Exception as e:
+        print(f"Remuxing {output.raw_path} failed: {e}")
+        if file:
+            file.close()
+        return False
+
+    os.replace(partial, output.path)
+    os.remove(output.raw_path)
+    os.remove(output.pts_path)
+    return True
+
+
+def write_playlist(storage, path, segments):
+    """Durably write an M3U playlist of (segment path, seconds) pairs
+
+    Segment paths are stored relative to the playlist, so the recording can
+    be moved as a whole. Returns the storage write's future.
+    """
+    base = os.path.dirname(path)
+    lines = ["#EXTM3U"]
+    for segment, seconds in segments:
+        lines.append(f"#EXTINF:{seconds:.3f},")
+        lines.append(os.path.relpath(segment, base))
+    return storage.write_file(path, ("\n".join(lines) + "\n").encode())
+
+
+def read_playlist(path):
+    """Segment paths of an M3U playlist, in playing order"""
+    base = os.path.dirname(path)
+    with open(path) as f:
+        return [
+            os.path.join(base, line.strip())
+            for line in f
+            if line.strip() and not line.startswith("#")
+        ]
+
+
+class SegmentedOutput(Output):
+    """Splits a recording into files of at most `seconds` or `max_bytes`.
+
+    Segments are made by make_output(path) and always start on a keyframe,
+    so the encoder must send keyframes with their SPS/PPS headers regularly;
+    a segment runs on until the first keyframe past its limit. The next
+    segment is opened in the background ahead of time, so switching costs
+    the encoder thread no more than handing frames to a new object and no
+    frame is lost at the seam. Finished segments are closed, passed through
+    finalize(output) when given (which returns success) and appended to
+    an M3U playlist on a background thread, in order; the playlist is
+    rewritten durably through `storage` after each one, so it only ever
+    lists complete files.
+    """
+
+    def __init__(self, directory, playlist_path, make_output, storage, seconds=0, max_bytes=0,
+                 finalize=None):
+        super().__init__()
+        self.directory = directory
+        self.playlist_path = playlist_path
+        self.make_output = make_output
+        self.storage = storage
+        self.seconds = seconds  # 0 for no time limit
+        self.max_bytes = max_bytes  # 0 for no size limit
+        self.finalize = finalize
+        self.opener = None
+        self.finisher = None
+        self.segments = []  # (path, seconds) of the finished segments
+
+        self.index = 0
+        self.current = None
+        self.spare = None  # Future of the next segment's started output
+        self.segment_bytes = 0
+        self.segment_frames = 0
+        self.first_timestamp = None
+        self.last_timestamp = None
+
+        self.lock = threading.Lock()
+
+        # Statistics
+        self.longest_switch = 0.0
+
+    def segment_path(self, index):
+        return os.path.join(self.directory, f"part_{index:04d}.mp4")
+
+    def open_segment(self, index):
+        output = self.make_output(self.segment_path(index))
+        output.start()
+        return output
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.opener = ThreadPoolExecutor(max_workers=1)
+        self.finisher = ThreadPoolExecutor(max_workers=1)
+        self.segments = []
+        self.index = 0
+        self.current = self.open_segment(0)
+        self.spare = self.opener.submit(self.open_segment, 1)
+        self.reset_segment()
+        super().start()
+
+    def reset_segment(self):
+        self.segment_bytes = 0
+        self.segment_frames = 0
+        self.first_timestamp = None
+        self.last_timestamp = None
+
+    def outputframe(self, frame, keyframe=True, timestamp=None, *args, **kwargs):
+        with self.lock:
+            if not self.recording:
+                return
+            if timestamp is None:
+                timestamp = int(time.monotonic() * 1e6)
+            if keyframe and self.segment_frames and self.segment_full(timestamp):
+                self.switch_segment(timestamp)
+
+            self.current.outputframe(frame, keyframe, timestamp)
+            self.segment_bytes += len(frame)
+            self.segment_frames += 1
+            if self.first_timestamp is None:
+                self.first_timestamp = timestamp
+            self.last_timestamp = timestamp
+
+    def segment_full(self, timestamp):
+        if self.seconds and timestamp - self.first_timestamp >= self.seconds * 1e6:
+            return True
+        return bool(self.max_bytes) and self.segment_bytes >= self.max_bytes
+
+    def switch_segment(self, timestamp):
+        started = time.perf_counter()
+        finished, self.current = self.current, self.spare.result()
+        # The segment ends where the next one starts
+        seconds = (timestamp - self.first_timestamp) / 1e6
+        self.finisher.submit(self.finish_segment, finished, self.index, seconds)
+        self.index += 1
+        self.spare = self.opener.submit(self.open_segment, self.index + 1)
+        self.reset_segment()
+        self.longest_switch = max(self.longest_switch, time.perf_counter() - started)
+
+    def finish_segment(self, output, index, seconds):
+        try:
+            output.stop()
+            if output.finished:
+                output.finished.result()
+            if self.finalize and not self.finalize(output):
+                print(f"Leaving segment {index} out of {self.playlist_path}")
+                return
+            self.segments.append((self.segment_path(index), seconds))
+            write_playlist(self.storage, self.playlist_path, self.segments).result()
+        except Exception as e:
+            print(f"Error finishing segment {index}: {e}")
+
+    def stop(self):
+        with self.lock:
+            if not self.recording:
+                return
+            super().stop()
+            seconds = 0.0
+            if self.segment_frames > 1:
+                # Count the last frame as long as the average one
+                span = self.last_timestamp - self.first_timestamp
+                seconds = span * self.segment_frames / (self.segment_frames - 1) / 1e6
+            self.finisher.submit(self.finish_segment, self.current, self.index, seconds)
+            self.opener.submit(self.discard, self.spare)
+            self.current = self.spare = None
+        # Let the last segments finish in the background
+        self.opener.shutdown(wait=False)
+        self.finisher.shutdown(wait=False)
+
+    def discard(self, spare):
+        """Close the unused next segment and remove whatever it created"""
+        output = spare.result()
+        output.stop()
+        if output.finished:
+            output.finished.result()
+        for path in (output.path, getattr(output, "raw_path", None), getattr(output, "pts_path", None)):
+            if path and os.path.exists(path):
+                os.remove(path)
+
+
+class FirstFrameOutput(Output):
+    """Wraps another output and reports when the first frame reaches it.
+
+    on_first_frame() is called from the encoder thread right after the
+    wrapped output has taken the first frame, which is how record start
+    latency is measured for every backend alike.
+    """
+
+    def __init__(self, output, on_first_frame):
+        super().__init__()
+        self.output = output
+        self.on_first_frame = on_first_frame
+        self.seen = False
+
+    def start(self):
+        self.output.start()
+        super().start()
+
+    def outputframe(self, frame, keyframe=True, timestamp=None, *args, **kwargs):
+        self.output.outputframe(frame, keyframe, timestamp)
+        if not self.seen:
+            self.seen = True
+            self.on_first_frame()
+
+    def stop(self):
+        super().stop()
+        self.output.stop()
+
+
+class PrerollOutput(Output):
+    """Keeps the last few seconds of encoded video in memory.
+
+    The encoder writes here all the time. Until start_recording() the
+    frames go into a queue trimmed to `seconds` of video and `max_bytes`,
+    always dropping whole groups of pictures so the queue starts on a
+    keyframe. start_recording() writes the queue to a real output and then
+    passes every new frame straight through, so a recording begins up to
+    `seconds` before the button was pressed. The encoder must repeat its
+    SPS/PPS headers on every keyframe for the flushed stream to decode.
+    """
+
+    def __init__(self, seconds, max_bytes):
+        super().__init__()
+        self.seconds = seconds
+        self.max_bytes = max_bytes
+        self.frames = deque()  # (frame bytes, keyframe, timestamp in us)
+        self.bytes = 0
+        self.sink = None
+        self.lock = threading.Lock()
+
+    def outputframe(self, frame, keyframe=True, timestamp=None, *args, **kwargs):
+        with self.lock:
+            if self.sink:
+                self.sink.outputframe(frame, keyframe, timestamp)
+                return
+
+            data = bytes(frame)  # The encoder reuses its buffer
+            self.frames.append((data, keyframe, timestamp))
+            self.bytes += len(data)
+            self.trim()
+
+    def trim(self):
+        """Drop the oldest group of pictures while the next one covers enough"""
+        while True:
+            # The second keyframe, where the queue would start after dropping
+            next_key = next(
+                (i for i, (_, keyframe, _) in enumerate(self.frames) if keyframe and i > 0),
+                None,
+            )
+            if next_key is None:
+                return
+            newest = self.frames[-1][2]
+            start = self.frames[next_key][2]
+            too_long = (
+                newest is not None and start is not None
+                and newest - start >= self.seconds * 1e6
+            )
+            if not too_long and self.bytes <= self.max_bytes:
+                return
+            for _ in range(next_key):
+                self.bytes -= len(self.frames.popleft()[0])
+
+    def start_recording(self, sink):
+        """Flush the buffered video to `sink` and keep recording into it"""
+        sink.start()
+        with self.lock:
+            for frame, keyframe, timestamp in self.frames:
+                sink.outputframe(frame, keyframe, timestamp)
+            self.frames.clear()
+            self.bytes = 0
+            self.sink = sink
+
+    def stop_recording(self):
+        """Stop the current recording and go back to buffering"""
+        with self.lock:
+            sink, self.sink = self.sink, None
+        if sink:
+            sink.stop()
+
+    def buffered(self):
+        """Seconds and bytes of video currently held"""
+        with self.lock:
+            if len(self.frames) < 2 or self.frames[0][2] is None:
+                return 0.0, self.bytes
+            return (self.frames[-1][2] - self.frames[0][2]) / 1e6, self.bytes
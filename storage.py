@@ -0,0 +1,305 @@
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+FSYNC_POLICIES = ("interval", "close", "never")
+
+
+class StorageFile:
+    """A file written through a StorageWriter; see StorageWriter.open()
+
+    Data is gathered into chunks of the writer's chunk size, so every write
+    that reaches the card but the last is a whole chunk at an offset that
+    is a multiple of it. There is no seek(), so muxers treat it as a stream.
+    """
+
+    def __init__(self, writer, path):
+        self.writer = writer
+        self.path = path
+        self.buffer = bytearray()
+        self.position = 0
+        self.fd = None  # Only touched on the writer thread
+        self.unsynced = 0
+        self.closed = None  # Future, once close() was called
+        writer.enqueue(0, self.do_open)
+
+    def write(self, data):
+        self.buffer += data
+        self.position += len(data)
+        chunk_size = self.writer.chunk_size
+        if len(self.buffer) >= chunk_size:
+            whole = len(self.buffer) // chunk_size * chunk_size
+            chunk = bytes(self.buffer[:whole])
+            del self.buffer[:whole]
+            self.writer.enqueue(len(chunk), lambda: self.do_write(chunk))
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        # Chunks are handed over as they fill; the tail waits for close()
+        pass
+
+    def close(self):
+        """Hand over the rest; returns a future that resolves once it's on the card"""
+        if self.closed is None:
+            tail, self.buffer = bytes(self.buffer), bytearray()
+            if tail:
+                self.writer.enqueue(len(tail), lambda: self.do_write(tail))
+            self.closed = self.writer.enqueue(0, self.do_close)
+        return self.closed
+
+    def do_open(self):
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+
+    def do_write(self, data):
+        view = memoryview(data)
+        while view:
+            written = self.writer.timed(os.write, self.fd, view)
+            view = view[written:]
+        self.unsynced += len(data)
+        if self.writer.fsync == "interval" and self.unsynced >= self.writer.fsync_bytes:
+            self.writer.timed(os.fdatasync, self.fd)
+            self.unsynced = 0
+
+    def do_close(self):
+        try:
+            if self.writer.fsync != "never":
+                self.writer.timed(os.fsync, self.fd)
+        finally:
+            os.close(self.fd)
+        if self.writer.fsync != "never":
+            self.writer.sync_directory(self.path)
+        return self.path
+
+
+class StorageWriter:
+    """Write-behind buffer between every output of the app and the card.
+
+    Stills and video hand their bytes over and go on; a single thread
+    writes them out in the order they came, in large chunks, which is
+    what SD cards are fastest at. The bytes waiting are capped at
+    `budget`: past it, writers block until the card catches up, and the
+    time they lose is recorded. The fsync policy is "interval" (every
+    `fsync_bytes` of a file and at close), "close" or "never".
+
+    Alongside the live write rate and queue depth it tracks the longest
+    single card operation (a stall) and the card's rate while busy, which
+    slow_card_warning() compares against what a recording needs.
+    """
+
+    def __init__(self, budget=64 * 1024 * 1024, chunk_size=1024 * 1024, fsync="interval",
+                 fsync_bytes=8 * 1024 * 1024):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy {fsync!r}")
+        self.budget = budget
+        self.chunk_size = chunk_size
+        self.fsync = fsync
+        self.fsync_bytes = fsync_bytes
+
+        self.condition = threading.Condition()
+        self.queued_bytes = 0
+        self.operations = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name="storage", daemon=True)
+        self.thread.start()
+
+        # Statistics
+        self.recent = deque()  # (monotonic time, bytes) of the last few seconds
+        self.written = 0
+        self.busy_time = 0.0  # Seconds spent in write and sync calls
+        self.longest_stall = 0.0  # Longest single write or sync call
+        self.longest_wait = 0.0  # Longest a writer was blocked on the budget
+        self.waits = 0
+
+    def open(self, path):
+        """A file-like object whose writes go through the buffer"""
+        return StorageFile(self, path)
+
+    def write_file(self, path, data):
+        """Durably replace `path` with `data`; returns a future of the path
+
+        The bytes go to `<path>.part`, which is fsynced and renamed over
+        `path`, and then the directory is fsynced so the rename itself is
+        on the card. The policy "never" skips both fsyncs.
+        """
+        data = bytes(data)
+        return self.enqueue(len(data), lambda: self.do_write_file(path, data))
+
+    def write_result(self, future, path):
+        """Write the bytes `future` produces to `path`; returns a future of the path"""
+        done = Future()
+
+        def produced(f):
+            if f.exception() is not None:
+                done.set_exception(f.exception())
+                return
+            self.write_file(path, f.result()).add_done_callback(lambda w: copy_result(w, done))
+
+        future.add_done_callback(produced)
+        return done
+
+    def enqueue(self, nbytes, operation):
+        """Queue `operation` for the writer thread, waiting while the budget is full"""
+        with self.condition:
+            # The writer thread can't wait for itself, e.g. from a done callback
+            if (self.queued_bytes and self.queued_bytes + nbytes > self.budget
+                    and threading.current_thread() is not self.thread):
+                started = time.monotonic()
+                # A single write larger than the budget is let through on its own
+                self.condition.wait_for(
+                    lambda: not self.queued_bytes or self.queued_bytes + nbytes <= self.budget
+                )
+                waited = time.monotonic() - started
+                self.waits += 1
+                self.longest_wait = max(self.longest_wait, waited)
+            self.queued_bytes += nbytes
+        future = Future()
+        self.operations.put((nbytes, operation, future))
+        return future
+
+    def run(self):
+        while True:
+            nbytes, operation, future = self.operations.get()
+            try:
+                future.set_result(operation())
+            except Exception as e:
+                print(f"Storage write error: {e}")
+                future.set_exception(e)
+            finally:
+                with self.condition:
+                    self.queued_bytes -= nbytes
+                    self.condition.notify_all()
+                self.count_written(nbytes)
+
+    def timed(self, call, *args):
+        """Run a card operation on the writer thread and account for its time"""
+        started = time.monotonic()
+        result = call(*args)
+        elapsed = time.monotonic() - started
+        self.busy_time += elapsed
+        self.longest_stall = max(self.longest_stall, elapsed)
+        return result
+
+    def count_written(self, nbytes):
+        if not nbytes:
+            return
+        now = time.monotonic()
+        with self.condition:
+            self.written += nbytes
+            self.recent.append((now, nbytes))
+            while self.recent and now - self.recent[0][0] > 2.0:
+                self.recent.popleft()
+
+    def do_write_file(self, path, data):
+        tmp_path = f"{path}.part"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            view = memoryview(data)
+            while view:
+                view = view[self.timed(os.write, fd, view[:self.chunk_size]):]
+            if self.fsync != "never":
+                self.timed(os.fsync, fd)
+        finally:
+            os.close(fd)
+        os.replace(tmp_path, path)
+        if self.fsync != "never":
+            self.sync_directory(path)
+        return path
+
+    def benchmark(self, directory, nbytes=8 * 1024 * 1024):
+        """Time writing and syncing `nbytes` in `directory`; a future of bytes per second
+
+        The test file goes through the queue like any other write, so the
+        result also seeds card_rate() before anything has been saved.
+        """
+        path = os.path.join(directory, ".storage_benchmark")
+        return self.enqueue(nbytes, lambda: self.do_benchmark(path, nbytes))
+
+    def do_benchmark(self, path, nbytes):
+        chunk = os.urandom(self.chunk_size)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            started = time.monotonic()
+            for offset in range(0, nbytes, self.chunk_size):
+                self.timed(os.write, fd, chunk[:nbytes - offset])
+            self.timed(os.fsync, fd)
+            elapsed = time.monotonic() - started
+        finally:
+            os.close(fd)
+            os.remove(path)
+        return nbytes / elapsed
+
+    def sync_directory(self, path):
+        dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+        try:
+            self.timed(os.fsync, dir_fd)
+        finally:
+            os.close(dir_fd)
+
+    def rate(self):
+        """Bytes per second written over the last two seconds"""
+        with self.condition:
+            if not self.recent:
+                return 0.0
+            return sum(nbytes for _, nbytes in self.recent) / 2.0
+
+    def card_rate(self, minimum=4 * 1024 * 1024):
+        """Bytes per second the card takes while busy, once `minimum` were written"""
+        if self.written < minimum or self.busy_time <= 0:
+            return None
+        return self.written / self.busy_time
+
+    def stats(self):
+        with self.condition:
+            queued = self.queued_bytes
+        return {
+            "rate": self.rate(),
+            "card_rate": self.card_rate(),
+            "queued": queued,
+            "operations": self.operations.qsize(),
+            "longest_stall": self.longest_stall,
+            "longest_wait": self.longest_wait,
+            "waits": self.waits,
+        }
+
+    def format_stats(self):
+        stats = self.stats()
+        return (
+            f"{stats['rate'] / 1e6:.1f} MB/s, queue {stats['queued'] / 1e6:.1f} MB, "
+            f"longest stall {stats['longest_stall'] * 1000:.0f} ms"
+        )
+
+    def slow_card_warning(self, bytes_per_second):
+        """A message if what's known of the card says a stream of `bytes_per_second` won't keep up"""
+        card_rate = self.card_rate()
+        if card_rate is not None and card_rate < bytes_per_second * 1.5:
+            return (
+                f"Slow card: it writes {card_rate / 1e6:.1f} MB/s, "
+                f"recording needs {bytes_per_second / 1e6:.1f} MB/s"
+            )
+        covered = self.budget / bytes_per_second
+        if self.longest_stall > covered / 2:
+            return (
+                f"Slow card: it stalled for {self.longest_stall:.1f} s, "
+                f"the write buffer covers {covered:.1f} s of video"
+            )
+        return None
+
+    def flush(self):
+        """Wait until everything queued so far is written
+
+        The writer thread keeps running, so outputs that are still being
+        finished in the background can complete while the app exits.
+        """
+        self.enqueue(0, lambda: None).result()
+
+
+def copy_result(source, target):
+    if source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
@@ -0,0 +1,174 @@
+import glob
+import json
+import math
+import os
+import shutil
+import subprocess
+import time
+
+from recording import STREAMING_MOVFLAGS, copy_to_storage
+
+STATE_FILE = "timelapse.json"
+
+
+class IntervalStats:
+    """Running mean, spread and extremes of the achieved capture intervals"""
+
+    def __init__(self, count=0, mean=0.0, m2=0.0, shortest=None, longest=None):
+        self.count = count
+        self.mean = mean
+        self.m2 = m2  # Sum of squared deviations, for Welford's update
+        self.shortest = shortest
+        self.longest = longest
+
+    def add(self, seconds):
+        self.count += 1
+        delta = seconds - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (seconds - self.mean)
+        self.shortest = seconds if self.shortest is None else min(self.shortest, seconds)
+        self.longest = seconds if self.longest is None else max(self.longest, seconds)
+
+    def jitter(self):
+        """Standard deviation of the intervals, in seconds"""
+        return math.sqrt(self.m2 / self.count) if self.count > 1 else 0.0
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "mean": self.mean,
+            "m2": self.m2,
+            "shortest": self.shortest,
+            "longest": self.longest,
+        }
+
+    def format(self):
+        if not self.count:
+            return "no intervals yet"
+        return (
+            f"interval {self.mean:.3f} s, jitter {self.jitter() * 1000.0:.1f} ms, "
+            f"range {self.shortest:.3f}-{self.longest:.3f} s"
+        )
+
+
+class TimelapseSession:
+    """A timelapse sequence whose progress is kept in a JSON file.
+
+    Frames go to their own directory under captures/, next to a state file
+    that is rewritten durably through `storage` after every frame, so an
+    interrupted sequence picks up at the next frame number when the app
+    starts again.
+    """
+
+    def __init__(self, directory, interval, frames, fps, storage):
+        self.directory = directory
+        self.storage = storage
+        self.interval = interval
+        self.frames = frames  # Frames to capture in total
+        self.fps = fps  # Playback rate of the assembled video
+        self.next_index = 0
+        self.missed = 0  # Scheduled slots skipped because we were late
+        self.status = "capturing"  # Then "assembling" and "done"
+        self.stats = IntervalStats()
+
+    @classmethod
+    def create(cls, root, interval, frames, fps, storage):
+        name = time.strftime("timelapse_%Y%m%d_%H%M%S")
+        directory = os.path.join(root, name)
+        os.makedirs(directory, exist_ok=True)
+        session = cls(directory, interval, frames, fps, storage)
+        session.save()
+        return session
+
+    @classmethod
+    def load(cls, directory, storage):
+        with open(os.path.join(directory, STATE_FILE)) as f:
+            state = json.load(f)
+        session = cls(directory, state["interval"], state["frames"], state["fps"], storage)
+        session.next_index = state["next_index"]
+        session.missed = state["missed"]
+        session.status = state["status"]
+        session.stats = IntervalStats(**state["stats"])
+        return session
+
+    @classmethod
+    def find_unfinished(cls, root, storage):
+        """Sessions in `root` that were interrupted before they were done"""
+        sessions = []
+        for path in sorted(glob.glob(os.path.join(root, "timelapse_*", STATE_FILE))):
+            try:
+                session = cls.load(os.path.dirname(path), storage)
+            except (OSError, ValueError, KeyError) as e:
+                print(f"Ignoring unreadable timelapse state {path}: {e}")
+                continue
+            if session.status != "done":
+                sessions.append(session)
+        return sessions
+
+    def save(self):
+        state = {
+            "interval": self.interval,
+            "frames": self.frames,
+            "fps": self.fps,
+            "next_index": self.next_index,
+            "missed": self.missed,
+            "status": self.status,
+            "stats": self.stats.to_dict(),
+        }
+        path = os.path.join(self.directory, STATE_FILE)
+        self.storage.write_file(path, json.dumps(state).encode()).result()
+
+    def remaining(self):
+        return max(self.frames - self.next_index, 0)
+
+    def frame_path(self, index):
+        return os.path.join(self.directory, f"frame_{index:05d}.jpg")
+
+    def video_path(self):
+        return f"{self.directory}.mp4"
+
+    def set_status(self, status):
+        self.status = status
+        self.save()
+
+
+def assemble_video(session):
+    """Start a low-priority ffmpeg that turns the session's frames into an MP4
+
+    Returns the Popen, or None if ffmpeg isn't installed. ffmpeg writes a
+    streaming MP4 to its stdout, which finish_assembly() copies through the
+    session's storage under a temporary name, renamed once ffmpeg succeeds.
+    """
+    if not shutil.which("ffmpeg"):
+        print("ffmpeg not found, can't assemble the timelapse video")
+        return None
+
+    command = [
+        "ffmpeg", "-y", "-loglevel", "error",
+        "-framerate", str(session.fps),
+        "-pattern_type", "glob", "-i", os.path.join(session.directory, "frame_*.jpg"),
+        "-c:v", "libx264", "-preset", "veryfast", "-pix_fmt", "yuv420p",
+        "-vf", "scale=trunc(iw/2)*2:trunc(ih/2)*2",
+        "-f", "mp4", "-movflags", STREAMING_MOVFLAGS, "-",
+    ]
+    # Lowest CPU and idle I/O priority, so the live preview isn't disturbed
+    if shutil.which("ionice"):
+        command = ["ionice", "-c", "3"] + command
+    command = ["nice", "-n", "19"] + command
+    return subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE)
+
+
+def finish_assembly(session, process):
+    """Save assemble_video's output as it comes; returns True once the MP4 is in place"""
+    part_path = f"{session.video_path()}.part"
+    file = session.storage.open(part_path)
+    copy_to_storage(process.stdout, file)
+    returncode = process.wait()
+    file.close().result()
+    if returncode != 0:
+        print(f"Timelapse assembly failed with exit code {returncode}")
+        os.remove(part_path)
+        return False
+    os.replace(part_path, session.video_path())
+    session.set_status("done")
+    return True
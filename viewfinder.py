@@ -0,0 +1,93 @@
+import ctypes
+
+import gi
+
+gi.require_version("Gtk", "4.0")
+from gi.repository import Gdk, GLib
+
+# PyGObject always copies when building a GLib.Bytes from Python data, so the
+# zero-copy path wraps the ring buffers through the C API directly: the
+# GBytes points at the numpy memory and its destroy notify hands the buffer
+# back to the ring once GTK drops the texture.
+try:
+    _glib = ctypes.CDLL("libglib-2.0.so.0")
+    _gobject = ctypes.CDLL("libgobject-2.0.so.0")
+    _gtk = ctypes.CDLL("libgtk-4.so.1")
+
+    _DestroyNotify = ctypes.CFUNCTYPE(None, ctypes.c_void_p)
+
+    _glib.g_bytes_new_with_free_func.restype = ctypes.c_void_p
+    _glib.g_bytes_new_with_free_func.argtypes = [
+        ctypes.c_void_p, ctypes.c_size_t, _DestroyNotify, ctypes.c_void_p,
+    ]
+    _glib.g_bytes_unref.argtypes = [ctypes.c_void_p]
+    _gtk.gdk_memory_texture_new.restype = ctypes.c_void_p
+    _gtk.gdk_memory_texture_new.argtypes = [
+        ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t,
+    ]
+    _gtk.gtk_picture_set_paintable.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+    _gobject.g_object_unref.argtypes = [ctypes.c_void_p]
+
+    ctypes.pythonapi.PyCapsule_GetPointer.restype = ctypes.c_void_p
+    ctypes.pythonapi.PyCapsule_GetPointer.argtypes = [ctypes.py_object, ctypes.c_char_p]
+
+    zero_copy_available = True
+except (OSError, AttributeError) as e:
+    print(f"Zero-copy viewfinder not available, falling back to copies: {e}")
+    zero_copy_available = False
+
+
+class ViewfinderSink:
+    """Shows FrameRing buffers in a GtkPicture as Gdk.MemoryTextures"""
+
+    def __init__(self, picture, ring):
+        self.picture = picture
+        self.ring = ring
+        self.format = int(Gdk.MemoryFormat.R8G8B8)
+
+        if zero_copy_available:
+            # Must outlive every texture handed to GTK
+            self.destroy_notify = _DestroyNotify(self.on_texture_released)
+            self.picture_ptr = ctypes.pythonapi.PyCapsule_GetPointer(
+                picture.__gpointer__, None
+            )
+
+    def show(self, index):
+        """Display ring buffer `index`; must be called from the main loop"""
+        if zero_copy_available:
+            self.show_zero_copy(index)
+        else:
+            self.show_copy(index)
+
+    def show_zero_copy(self, index):
+        frame = self.ring.buffers[index]
+        gbytes = _glib.g_bytes_new_with_free_func(
+            frame.ctypes.data, frame.nbytes, self.destroy_notify, index
+        )
+        texture = _gtk.gdk_memory_texture_new(
+            self.ring.width, self.ring.height, self.format, gbytes, self.ring.stride
+        )
+        _glib.g_bytes_unref(gbytes)  # The texture holds its own reference
+
+        _gtk.gtk_picture_set_paintable(self.picture_ptr, texture)
+        _gobject.g_object_unref(texture)  # Now owned by the picture
+        self.ring.record_display(0)
+
+    def show_copy(self, index):
+        frame = self.ring.buffers[index]
+        data = frame.tobytes()
+        texture = Gdk.MemoryTexture.new(
+            self.ring.width,
+            self.ring.height,
+            Gdk.MemoryFormat.R8G8B8,
+            GLib.Bytes.new(data),
+            self.ring.stride,
+        )
+        self.ring.release(index)
+        self.picture.set_paintable(texture)
+        # tobytes() plus the copy GLib.Bytes makes of it
+        self.ring.record_display(2 * len(data))
+
+    def on_texture_released(self, index):
+        # GDestroyNotify passes user_data back as the buffer index
+        self.ring.release(index or 0)